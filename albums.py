@@ -114,7 +114,7 @@ def _parse_smart_form(rf):
 
 def smart_calculate():
     parsed = _parse_smart_form(request.form)
-    recs = entities.Album.records_for_rules(parsed)
+    recs = entities.Album.records_for_rules(parsed, columns="image.pkid, image.name")
     return json.dumps({rec["pkid"]: rec["name"] for rec in recs})
 
 
@@ -168,7 +168,7 @@ def manage_images(album_id, filter_term=None):
 
 def view_smart_images(album_obj):
     g.album = album_obj.to_dict()
-    g.images = entities.Album.smart_album_images(album_obj.pkid)
+    g.images = album_obj.images
     g.image_count = len(g.images)
     return render_template("album_images.html")
 
@@ -183,10 +183,10 @@ def manage_images_POST(album_id):
     return redirect("/albums")
 
 
-def update_frame_album(album_id, image_ids=None):
-    """Updates the 'images' key for all frames that are linked to the album."""
+def update_frame_album(album_id):
+    """Sends the full list of images to all frames that are linked to the album."""
     album = entities.Album.get(album_id)
-    album.update_frame_album(image_ids)
+    album.update_frame_album()
 
 
 def update_frameset_album(album_id, image_ids=None):
@@ -203,5 +203,4 @@ def update_frameset_album(album_id, image_ids=None):
         sql = "select name from image where pkid in %s;"
         crs.execute(sql, (image_ids,))
         image_names = [rec["name"] for rec in crs.fetchall()]
-        for frameset_id in frameset_ids:
-            utils.write_key(frameset_id, "images", image_names)
+        utils.after_commit(utils.write_keys, frameset_ids, "images", image_names)
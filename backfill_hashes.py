@@ -0,0 +1,29 @@
+"""Computes the content hash of each image that doesn't have one yet, such as those
+added before the content_hash column existed. The column is added first if it doesn't
+exist yet. The files are hashed in parallel.
+
+    python backfill_hashes.py              # one process per CPU
+    python backfill_hashes.py --workers 4
+"""
+import argparse
+
+import db_create
+import images
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill in the content hashes of the images.")
+    parser.add_argument("--folder", help="The image folder; defaults to the server's folder")
+    parser.add_argument("--workers", type=int, help="Number of processes; defaults to the CPUs")
+    args = parser.parse_args()
+    with utils.DbCursor() as crs:
+        db_create.upgrade(crs)
+    hashed, duplicates = images.backfill_hashes(args.folder, workers=args.workers)
+    print("Hashed {} images".format(hashed))
+    for original, duplicate in duplicates:
+        print("'{}' has the same contents as '{}'".format(duplicate, original))
+
+
+if __name__ == "__main__":
+    main()
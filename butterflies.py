@@ -12,7 +12,9 @@ def show_butterflies():
 
 def random_butterfly():
     crs = utils.get_cursor()
-    sql = "select name from image where keywords like '%2020%' order by rand() limit 1;"
+    sql = """select image.name from image
+            join image_keyword on image_keyword.image_id = image.pkid
+            where image_keyword.keyword = '2020' order by rand() limit 1;"""
     crs.execute(sql)
     fname = crs.fetchone()["name"]
     return json.dumps(fname)
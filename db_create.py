@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import sys
+
 import utils
 
 
@@ -65,8 +67,12 @@ def create_image(crs):
         orientation ENUM('H', 'V', 'S') NOT NULL,
         imgtype VARCHAR(6),
         size INT,
+        content_hash CHAR(64),
         created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated TIMESTAMP
+        updated TIMESTAMP,
+        UNIQUE INDEX image_content_hash (content_hash),
+        INDEX image_name_pkid (name, pkid),
+        INDEX image_orientation_name_pkid (orientation, name, pkid)
         );
     """
     crs.execute(sql)
@@ -83,6 +89,8 @@ def create_album(crs):
         orientation ENUM('H', 'V', 'S') NOT NULL,
         parent_id VARCHAR(36),
         smart TINYINT(1) DEFAULT 0,
+        rules TEXT,
+        images_version INT NOT NULL DEFAULT 0,
         updated TIMESTAMP
         );
     """
@@ -102,6 +110,81 @@ def create_album_image(crs):
     crs.execute(sql)
 
 
+def create_frame_heartbeat(crs, replace=True):
+    if replace:
+        sql = "drop table if exists frame_heartbeat;"
+        crs.execute(sql)
+    sql = """
+    create table if not exists frame_heartbeat (
+        frame_id VARCHAR(36) NOT NULL PRIMARY KEY,
+        ip VARCHAR(16),
+        freespace BIGINT,
+        current_image VARCHAR(256),
+        uptime INT UNSIGNED,
+        temperature DECIMAL (5,2),
+        received DATETIME(6) NOT NULL
+        );
+    """
+    crs.execute(sql)
+
+
+def create_ingest_job(crs, replace=True):
+    if replace:
+        sql = "drop table if exists ingest_job;"
+        crs.execute(sql)
+    sql = """
+    create table if not exists ingest_job (
+        pkid VARCHAR(36) NOT NULL PRIMARY KEY,
+        batch_id VARCHAR(36) NOT NULL,
+        idempotency_key VARCHAR(64) NOT NULL,
+        fpath VARCHAR(1024) NOT NULL,
+        keywords VARCHAR(256),
+        stage VARCHAR(16) NOT NULL,
+        status ENUM('pending', 'running', 'done', 'failed') NOT NULL DEFAULT 'pending',
+        attempts SMALLINT NOT NULL DEFAULT 0,
+        last_error TEXT,
+        image_id VARCHAR(36),
+        duplicate TINYINT(1) NOT NULL DEFAULT 0,
+        claimed_by VARCHAR(64),
+        claimed_at DATETIME,
+        run_after DATETIME NOT NULL,
+        created DATETIME NOT NULL,
+        UNIQUE INDEX ingest_job_idempotency_key (idempotency_key),
+        INDEX ingest_job_batch_id (batch_id),
+        INDEX ingest_job_status_stage (status, stage, run_after)
+        );
+    """
+    crs.execute(sql)
+
+
+def create_image_keyword(crs, replace=True):
+    if replace:
+        sql = "drop table if exists image_keyword;"
+        crs.execute(sql)
+    sql = """
+    create table if not exists image_keyword (
+        image_id VARCHAR(36) NOT NULL,
+        keyword VARCHAR(256) NOT NULL,
+        PRIMARY KEY (keyword, image_id),
+        INDEX image_keyword_image_id (image_id)
+        );
+    """
+    crs.execute(sql)
+
+
+def create_keyword_vocab(crs, replace=True):
+    if replace:
+        sql = "drop table if exists keyword_vocab;"
+        crs.execute(sql)
+    sql = """
+    create table if not exists keyword_vocab (
+        keyword VARCHAR(256) NOT NULL PRIMARY KEY,
+        image_count INT NOT NULL DEFAULT 0
+        );
+    """
+    crs.execute(sql)
+
+
 def create_rule(crs):
     sql = "drop table if exists rule;"
     crs.execute(sql)
@@ -116,15 +199,113 @@ def create_rule(crs):
     crs.execute(sql)
 
 
+def create_login_indexes(crs):
+    """The login table is checked by token on every request, and purged of
+    expired tokens periodically. Indexes that already exist are skipped, so this
+    is safe to run on an existing database. It is the same as running:
+
+        create index login_token on login (token);
+        create index login_expires on login (expires);
+    """
+    crs.execute("show tables like 'login';")
+    if not crs.fetchone():
+        # The user and login tables aren't created by this script
+        return
+    add_index(crs, "login", "login_token", "token")
+    add_index(crs, "login", "login_expires", "expires")
+
+
+def _columns(crs, table):
+    """Returns a dict of the table's column names and their info."""
+    # MySQL 8 returns information_schema columns in upper case, unless they're aliased
+    sql = """select column_name as column_name, datetime_precision as datetime_precision
+            from information_schema.columns
+            where table_schema = database() and table_name = %s;"""
+    crs.execute(sql, (table,))
+    return {rec["column_name"]: rec for rec in crs.fetchall()}
+
+
+def _index_names(crs, table, unique=False):
+    sql = """select index_name as index_name from information_schema.statistics
+            where table_schema = database() and table_name = %s"""
+    if unique:
+        sql += " and non_unique = 0"
+    crs.execute(sql, (table,))
+    return {rec["index_name"] for rec in crs.fetchall()}
+
+
+def add_column(crs, table, column, definition):
+    """Adds the column to an existing table, unless it's already there."""
+    if column not in _columns(crs, table):
+        crs.execute("alter table {} add column {} {};".format(table, column, definition))
+
+
+def add_index(crs, table, index_name, columns, unique=False):
+    """Adds the index to an existing table, unless it's already there. If a unique index
+    is wanted, and there's a non-unique one of that name, it is replaced.
+    """
+    if index_name in _index_names(crs, table, unique=unique):
+        return
+    if unique and index_name in _index_names(crs, table):
+        crs.execute("drop index {} on {};".format(index_name, table))
+    sql = "create {}index {} on {} ({});".format(
+        "unique " if unique else "", index_name, table, columns
+    )
+    crs.execute(sql)
+
+
+def upgrade(crs):
+    """Brings the tables of an existing database up to date, without losing any data:
+    missing tables are created, and missing columns and indexes are added. Everything
+    that is already there is left alone, so this is safe to run more than once. Run it
+    with `python db_create.py --upgrade`.
+
+    The new image_keyword, keyword_vocab and content_hash data isn't filled in here;
+    run rebuild_keywords.py and backfill_hashes.py, which call this first.
+    """
+    create_frame_heartbeat(crs, replace=False)
+    create_ingest_job(crs, replace=False)
+    create_image_keyword(crs, replace=False)
+    create_keyword_vocab(crs, replace=False)
+    add_column(crs, "album", "rules", "TEXT")
+    add_column(crs, "album", "images_version", "INT NOT NULL DEFAULT 0")
+    add_column(crs, "image", "content_hash", "CHAR(64)")
+    add_column(crs, "ingest_job", "duplicate", "TINYINT(1) NOT NULL DEFAULT 0")
+    # The hash of a duplicate image is left NULL, so that content_hash can be unique
+    sql = """update image i join (
+                select content_hash, min(pkid) as keep from image
+                where content_hash is not null group by content_hash having count(*) > 1
+            ) dup on i.content_hash = dup.content_hash
+            set i.content_hash = null where i.pkid != dup.keep;"""
+    crs.execute(sql)
+    add_index(crs, "image", "image_content_hash", "content_hash", unique=True)
+    add_index(crs, "image", "image_name_pkid", "name, pkid")
+    add_index(crs, "image", "image_orientation_name_pkid", "orientation, name, pkid")
+    # Heartbeats from different workers are compared by the time they were received
+    if _columns(crs, "frame_heartbeat")["received"]["datetime_precision"] != 6:
+        crs.execute("alter table frame_heartbeat modify received DATETIME(6) NOT NULL;")
+    create_login_indexes(crs)
+    crs.connection.commit()
+
+
 def main(crs):
     create_frame(crs)
     create_frameset(crs)
-    create_image(crs)
+    create_frame_heartbeat(crs)
+    create_ingest_job(crs)
+    # These must exist before create_image() loads the images from disk
+    create_image_keyword(crs)
+    create_keyword_vocab(crs)
     create_album(crs)
     create_album_image(crs)
+    create_image(crs)
+    create_login_indexes(crs)
     crs.connection.commit()
 
 
 if __name__ == "__main__":
     with utils.DbCursor() as crs:
-        main(crs)
+        if "--upgrade" in sys.argv:
+            upgrade(crs)
+        else:
+            main(crs)
@@ -1,9 +1,12 @@
 from __future__ import print_function
 
+import base64
 import copy
 import dataclasses
 from datetime import datetime
 from decimal import Decimal
+import heapq
+import itertools
 import json
 import random
 
@@ -13,10 +16,48 @@ import exceptions as exc
 import utils
 
 
+def _encode_page_token(key_vals, backwards=False):
+    payload = json.dumps({"k": key_vals, "b": backwards}, default=str)
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def _decode_page_token(token):
+    """Returns the page key values and direction stored in a page token. An
+    empty or mangled token is treated as a request for the first page.
+    """
+    if not token:
+        return None, False
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        key_vals, backwards = payload["k"], payload["b"]
+    except (ValueError, TypeError, KeyError):
+        return None, False
+    # The token came from the client, so check that it has the shape we gave it
+    if not isinstance(key_vals, list) or not isinstance(backwards, bool):
+        return None, False
+    if not all(isinstance(val, (str, int, float)) for val in key_vals):
+        return None, False
+    return key_vals, backwards
+
+
+@dataclasses.dataclass
+class Page:
+    items: list
+    next_token: str = None
+    prev_token: str = None
+
+
+def _image_id(img):
+    """Accepts either an Image object or an image ID, and returns the ID."""
+    return img.pkid if isinstance(img, Image) else img
+
+
 class Base:
     table_name = None
     non_db_fields = []
     custom_list = False
+    # The columns that give records a stable, unique order for paging
+    page_key = ("pkid",)
 
     @classmethod
     def get(cls, pkid_or_obj):
@@ -35,12 +76,46 @@ class Base:
             raise exc.NotFound()
         # Allow subclasses to customize the response
         cls._after_get(rec)
-        return cls(**rec)
+        obj = cls(**rec)
+        # Remember the stored values, so that saving doesn't have to re-read them
+        obj._loaded = {fld: rec[fld] for fld in obj.db_field_names if fld in rec}
+        return obj
 
     @classmethod
-    def _after_get(cls, rec):
+    def get_many(cls, pkids):
+        """Returns the objects for a list of IDs, in the same order, with one query for the
+        records and one for each relation that `_preload()` resolves. IDs that don't
+        match a record are skipped.
+        """
+        pkids = list(pkids)
+        if not pkids:
+            return []
+        sql = "select * from {} where pkid in %s;".format(cls.table_name)
+        with utils.DbCursor() as crs:
+            crs.execute(sql, (pkids,))
+        recs = {rec["pkid"]: rec for rec in crs.fetchall()}
+        cls._preload(list(recs.values()))
+        objs = []
+        for pkid in pkids:
+            rec = recs.get(pkid)
+            if rec is None:
+                continue
+            obj = cls(**rec)
+            obj._loaded = {fld: rec[fld] for fld in obj.db_field_names if fld in rec}
+            objs.append(obj)
+        return objs
+
+    @classmethod
+    def _preload(cls, recs):
+        """Adds any related values, such as names and counts from other tables, to a batch
+        of records. Subclasses should use a single query per relation for the whole batch.
+        """
         pass
 
+    @classmethod
+    def _after_get(cls, rec):
+        cls._preload([rec])
+
     @classmethod
     def list(cls, **kwargs):
         """Get all the records for this class.
@@ -48,30 +123,102 @@ class Base:
         They can be optionally filtered by the key/value pairs in kwargs
         """
         sql = "select * from {}".format(cls.table_name)
-        if cls.custom_list:
-            where_clause = cls._custom_where(**kwargs)
-            vals = tuple()
-        else:
-            wheres = ["{} = %s".format(fld) for fld in kwargs.keys()]
-            vals = kwargs.values()
-            where_clause = " and ".join(wheres)
+        where_clause, vals = cls._where(**kwargs)
         if where_clause:
             sql = "{} where {}".format(sql, where_clause)
         print("SQL", sql)
         with utils.DbCursor() as crs:
-            crs.execute(sql, *vals)
+            crs.execute(sql, vals)
         recs = crs.fetchall()
         # Allow subclasses to customize the results
         cls._after_list(recs)
         return cls.from_recs(recs)
 
+    @classmethod
+    def list_page(cls, page_size=None, page_token=None, **kwargs):
+        """Get a single page of records, filtered the same way as `list()`.
+
+        Pages are found by seeking past the `page_key` values of the last
+        record on the previous page rather than by offset, so the cost of a
+        page doesn't grow with its position. `page_token` is an opaque value
+        taken from the `next_token` or `prev_token` of a previous Page.
+        """
+        page_size = page_size or utils.DEFAULT_PAGE_SIZE
+        key_vals, backwards = _decode_page_token(page_token)
+        where_clause, vals = cls._where(**kwargs)
+        wheres = [where_clause] if where_clause else []
+        if key_vals is not None and len(key_vals) == len(cls.page_key):
+            seek_clause, seek_vals = cls._seek_clause(key_vals, "<" if backwards else ">")
+            wheres.append(seek_clause)
+            vals = (*vals, *seek_vals)
+        direction = "desc" if backwards else "asc"
+        order_by = ", ".join("{} {}".format(fld, direction) for fld in cls.page_key)
+        sql = "select * from {}".format(cls.table_name)
+        if wheres:
+            sql = "{} where {}".format(sql, " and ".join(wheres))
+        # Ask for one extra record to find out if there are more beyond this page
+        sql = "{} order by {} limit %s".format(sql, order_by)
+        with utils.DbCursor() as crs:
+            crs.execute(sql, (*vals, page_size + 1))
+        recs = crs.fetchall()
+        has_more = len(recs) > page_size
+        recs = recs[:page_size]
+        if backwards:
+            recs.reverse()
+        cls._after_list(recs)
+        items = cls.from_recs(recs)
+        next_token = prev_token = None
+        if recs:
+            first = [recs[0][fld] for fld in cls.page_key]
+            last = [recs[-1][fld] for fld in cls.page_key]
+            if has_more or backwards:
+                next_token = _encode_page_token(last)
+            if (has_more and backwards) or (key_vals is not None and not backwards):
+                prev_token = _encode_page_token(first, backwards=True)
+        return Page(items=items, next_token=next_token, prev_token=prev_token)
+
+    @classmethod
+    def count(cls, **kwargs):
+        """Return the number of records matching the same filters as `list()`."""
+        sql = "select count(*) as num_recs from {}".format(cls.table_name)
+        where_clause, vals = cls._where(**kwargs)
+        if where_clause:
+            sql = "{} where {}".format(sql, where_clause)
+        with utils.DbCursor() as crs:
+            crs.execute(sql, vals)
+        return crs.fetchone()["num_recs"]
+
+    @classmethod
+    def _where(cls, **kwargs):
+        """Returns the where clause and its parameter values for the filters in
+        kwargs.
+        """
+        if cls.custom_list:
+            return cls._custom_where(**kwargs)
+        wheres = ["{} = %s".format(fld) for fld in kwargs.keys()]
+        return " and ".join(wheres), tuple(kwargs.values())
+
+    @classmethod
+    def _seek_clause(cls, key_vals, op):
+        """Expands the row comparison `page_key > key_vals` so that MySQL can
+        use the index on the page_key columns.
+        """
+        ors = []
+        vals = []
+        for pos, fld in enumerate(cls.page_key):
+            ands = ["{} = %s".format(prev) for prev in cls.page_key[:pos]]
+            ands.append("{} {} %s".format(fld, op))
+            ors.append("({})".format(" and ".join(ands)))
+            vals.extend(key_vals[: pos + 1])
+        return "({})".format(" or ".join(ors)), tuple(vals)
+
     @classmethod
     def _custom_where(cls, **kwargs):
-        pass
+        return "", tuple()
 
     @classmethod
     def _after_list(cls, recs):
-        pass
+        cls._preload(recs)
 
     @classmethod
     def delete(cls, pkid):
@@ -110,16 +257,21 @@ class Base:
         pass
 
     def _update(self):
-        # Get the changed fields
-        sql = "select * from {} where pkid = %s".format(self.table_name)
+        # Get the changed fields. Compare with the values from when the object was
+        # loaded, if it was; otherwise, read the current record.
+        rec = getattr(self, "_loaded", None)
         with utils.DbCursor() as crs:
-            crs.execute(sql, (self.pkid,))
-            rec = crs.fetchone()
+            if rec is None:
+                sql = "select * from {} where pkid = %s".format(self.table_name)
+                crs.execute(sql, (self.pkid,))
+                rec = crs.fetchone()
             changes = []
             values = []
-            for fld, val in rec.items():
+            for fld in self.db_field_names:
+                if fld not in rec:
+                    continue
                 obj_val = getattr(self, fld)
-                if obj_val != val:
+                if obj_val != rec[fld]:
                     changes.append("{}=%s".format(fld))
                     values.append(obj_val)
             if not changes:
@@ -128,12 +280,18 @@ class Base:
             set_clause = ", ".join(changes)
             sql = "update {} set {} where pkid=%s".format(self.table_name, set_clause)
             crs.execute(sql, (*values, self.pkid))
+        self._loaded = {fld: getattr(self, fld) for fld in self.db_field_names if fld in rec}
 
     def _save_new(self):
         # New frames may specify their pkid, so if it's there, use that
         self.pkid = self.pkid or utils.gen_uuid()
         field_names = ", ".join(self.db_field_names)
-        values = tuple([str(getattr(self, field, None)) for field in self.db_field_names])
+        values = tuple(
+            [
+                None if getattr(self, field, None) is None else str(getattr(self, field))
+                for field in self.db_field_names
+            ]
+        )
         value_placeholders = ", ".join(["%s"] * len(self.db_field_names))
         sql = "insert into {} ({}) values ({})".format(
             self.table_name, field_names, value_placeholders
@@ -152,9 +310,105 @@ class Base:
         ]
 
 
+class SubAlbumAllocator:
+    """Spreads the images of an album evenly across its sub-albums.
+
+    It is given the current membership of each sub-album as a dict of album
+    ID to a set of image IDs. Images can then be added and removed, and the
+    albums rebalanced, all in memory; `changes()` returns the rows that need
+    to be inserted into and deleted from album_image to match. Two heaps
+    keyed by image count find the smallest and largest sub-albums. Entries
+    in them go stale as counts change, and are discarded when popped.
+    """
+
+    def __init__(self, membership):
+        self.original = {album_id: set(images) for album_id, images in membership.items()}
+        self.membership = {album_id: set(images) for album_id, images in membership.items()}
+        self.location = {
+            img_id: album_id for album_id, images in membership.items() for img_id in images
+        }
+        self._min_heap = []
+        self._max_heap = []
+        self._seq = itertools.count()
+        for album_id in self.membership:
+            self._push(album_id)
+
+    def _push(self, album_id):
+        count = len(self.membership[album_id])
+        seq = next(self._seq)
+        heapq.heappush(self._min_heap, (count, seq, album_id))
+        heapq.heappush(self._max_heap, (-count, seq, album_id))
+
+    def _peek(self, heap, sign):
+        while heap:
+            count, seq, album_id = heap[0]
+            if sign * count == len(self.membership[album_id]):
+                return album_id
+            # Stale entry
+            heapq.heappop(heap)
+        return None
+
+    def smallest(self):
+        return self._peek(self._min_heap, 1)
+
+    def largest(self):
+        return self._peek(self._max_heap, -1)
+
+    def add(self, img_id, album_id=None):
+        """Adds the image to the given sub-album, or to the smallest one."""
+        if img_id in self.location:
+            return
+        album_id = album_id or self.smallest()
+        if album_id is None:
+            return
+        self.membership[album_id].add(img_id)
+        self.location[img_id] = album_id
+        self._push(album_id)
+
+    def remove(self, img_id):
+        album_id = self.location.pop(img_id, None)
+        if album_id is None:
+            # No sub-album has that image
+            return
+        self.membership[album_id].discard(img_id)
+        self._push(album_id)
+
+    def rebalance(self):
+        """Moves randomly chosen images from the largest sub-album to the
+        smallest until no two differ by more than one image.
+        """
+        while True:
+            largest, smallest = self.largest(), self.smallest()
+            if largest is None:
+                return
+            if len(self.membership[largest]) - len(self.membership[smallest]) <= 1:
+                return
+            img_id = random.choice(tuple(self.membership[largest]))
+            self.remove(img_id)
+            self.add(img_id, smallest)
+
+    def changes(self):
+        """Returns two lists of (album_id, image_id) tuples: the rows to add to
+        album_image and the rows to delete from it.
+        """
+        adds = []
+        removes = []
+        for album_id, images in self.membership.items():
+            original = self.original[album_id]
+            adds.extend((album_id, img_id) for img_id in sorted(images - original))
+            removes.extend((album_id, img_id) for img_id in sorted(original - images))
+        return adds, removes
+
+
 # TODO: When modifying an album, need to update any sub-albums
 
 
+# The image names of each album, as {album_id: (images_version, image_names)}
+_album_image_names = {}
+# The cached version for an album whose names haven't been cached
+_NOT_CACHED = object()
+
+
 @dataclasses.dataclass
 class Album(Base):
     pkid: str = ""
@@ -164,6 +418,7 @@ class Album(Base):
     parent_id: str = ""
     smart: bool = False
     rules: str = ""
+    images_version: int = 0
 
     table_name = "album"
     DEFAULT_ALBUM_NAME = "calibrate"
@@ -244,8 +499,6 @@ class Album(Base):
 
     @property
     def images(self):
-        if self.smart:
-            return self.smart_album_images(self.pkid)
         sql = (
             "select image.* from image join album_image "
             "on album_image.image_id = image.pkid "
@@ -257,38 +510,28 @@ class Album(Base):
 
     @property
     def image_ids(self):
-        if self.smart:
-            recs = self.smart_album_images(self.pkid, return_objects=False)
-        else:
-            sql = """select image.pkid from image
-                    join album_image on album_image.image_id = image.pkid
-                    where album_image.album_id = %s"""
-            with utils.DbCursor() as crs:
-                crs.execute(sql, self.pkid)
-            recs = crs.fetchall()
-        return [rec["pkid"] for rec in recs]
+        sql = """select image.pkid from image
+                join album_image on album_image.image_id = image.pkid
+                where album_image.album_id = %s"""
+        with utils.DbCursor() as crs:
+            crs.execute(sql, self.pkid)
+        return [rec["pkid"] for rec in crs.fetchall()]
 
     @property
     def image_names(self):
-        if self.smart:
-            recs = self.smart_album_images(self.pkid, return_objects=False)
-        else:
-            sql = """select image.name from image
-                    join album_image on album_image.image_id = image.pkid
-                    where album_image.album_id = %s"""
-            with utils.DbCursor() as crs:
-                crs.execute(sql, self.pkid)
-            recs = crs.fetchall()
-        return [rec["name"] for rec in recs]
+        sql = """select image.name from image
+                join album_image on album_image.image_id = image.pkid
+                where album_image.album_id = %s"""
+        with utils.DbCursor() as crs:
+            crs.execute(sql, self.pkid)
+        return [rec["name"] for rec in crs.fetchall()]
 
     @property
     def image_count(self):
         return self._get_image_count(self.pkid)
 
     @classmethod
-    def _get_image_count(cls, pkid, smart=False):
-        if smart:
-            return len(cls.smart_album_images(pkid))
+    def _get_image_count(cls, pkid):
         sql = """select count(*) as image_count from image
                 join album_image on album_image.image_id = image.pkid
                 where album_image.album_id = %s"""
@@ -298,25 +541,108 @@ class Album(Base):
 
     @classmethod
     def add_image_counts(cls, recs):
-        """Add the image_count property as a key in each record."""
+        """Add the image_count property as a key in each record. All the counts,
+        including those for smart albums, come from a single query.
+        """
+        if not recs:
+            return
+        sql = """select album_image.album_id, count(*) as image_count from album_image
+                join image on image.pkid = album_image.image_id
+                where album_image.album_id in %s
+                group by album_image.album_id"""
+        with utils.DbCursor() as crs:
+            crs.execute(sql, ([rec["pkid"] for rec in recs],))
+        counts = {rec["album_id"]: rec["image_count"] for rec in crs.fetchall()}
         for rec in recs:
-            rec["image_count"] = cls._get_image_count(rec["pkid"], rec["smart"])
+            rec["image_count"] = counts.get(rec["pkid"], 0)
+
+    # Smart album membership is stored in album_image just like that of regular
+    # albums. It is recalculated in full only when the rules change; when an
+    # image is added or edited, just that image is checked against the rules.
+
+    def refresh_smart_membership(self):
+        """Recalculates the images in this smart album from its rules. Returns
+        the sets of image IDs that were added and removed.
+        """
+        rules = json.loads(self.rules or "[]")
+        recs = self.records_for_rules(rules, columns="image.pkid")
+        matching_ids = {rec["pkid"] for rec in recs}
+        current_ids = set(self.image_ids)
+        to_remove = current_ids.difference(matching_ids)
+        to_add = matching_ids.difference(current_ids)
+        return self.update_membership(add=to_add, remove=to_remove)
+
+    @classmethod
+    def refresh_all_smart_albums(cls):
+        """Recalculates every smart album, and updates the frames for those whose
+        membership changed. Used after a bulk import of images.
+        """
+        for album in cls.list(smart=True):
+            added, removed = album.refresh_smart_membership()
+            if added or removed:
+                album.update_frame_album(added, removed)
 
     @classmethod
-    def smart_album_images(cls, pkid, return_objects=True):
-        sql = "select rules from album where album.pkid = %s"
+    def refresh_smart_albums_for_image(cls, image_id):
+        """Checks a single new or edited image against the rules of every smart
+        album, adding it to or removing it from those whose rules now give a
+        different answer. The frames for only those albums are updated.
+        Returns the list of albums that changed.
+        """
         with utils.DbCursor() as crs:
-            crs.execute(sql, pkid)
-        rules = json.loads(crs.fetchone()["rules"])
-        recs = cls.records_for_rules(rules)
-        if return_objects:
-            return Image.from_recs(recs)
-        return recs
+            crs.execute("select * from album where smart = 1;")
+            smart_albums = cls.from_recs(crs.fetchall())
+            if not smart_albums:
+                return []
+            # One query that returns the ID of each smart album the image matches
+            parts = []
+            vals = []
+            for album in smart_albums:
+                rules = json.loads(album.rules or "[]")
+                join_clause, where_clause, params = cls._rules_clauses(rules)
+                parts.append(
+                    f"(select %s as album_id from image {join_clause} where image.pkid = %s "
+                    f"{'and' if where_clause else ''} {where_clause} limit 1)"
+                )
+                vals.extend([album.pkid, image_id, *params])
+            crs.execute(" union all ".join(parts), vals)
+            matching_ids = {rec["album_id"] for rec in crs.fetchall()}
+            sql = "select album_id from album_image where image_id = %s;"
+            crs.execute(sql, (image_id,))
+            current_ids = {rec["album_id"] for rec in crs.fetchall()}
+        changed = []
+        for album in smart_albums:
+            is_match = album.pkid in matching_ids
+            if is_match == (album.pkid in current_ids):
+                continue
+            if is_match:
+                album.add_image(image_id)
+                album.update_frame_album(added=[image_id])
+            else:
+                album.remove_image(image_id)
+                album.update_frame_album(removed=[image_id])
+            changed.append(album)
+        return changed
+
+    @classmethod
+    def records_for_rules(cls, rules, columns="image.*"):
+        join_clause, where_clause, params = cls._rules_clauses(rules)
+        sql = (
+            f"select distinct {columns} from image {join_clause} "
+            f"{'where' if where_clause else ''} {where_clause}"
+        )
+        with utils.DbCursor() as crs:
+            crs.execute(sql, params)
+        return crs.fetchall()
 
     @classmethod
-    def records_for_rules(cls, rules):
+    def _rules_clauses(cls, rules):
+        """Returns the join and where clauses that select the images matching
+        a smart album's rules, and the list of parameters for the where clause.
+        """
         filters = []
         joins = []
+        params = []
         mthds = {
             "keywords": cls._filter_keywords,
             "name": cls._filter_name,
@@ -332,74 +658,82 @@ class Album(Base):
             val = compval[comp]
             mthd = mthds[field]
             if comp is not None:
-                mthd(comp.lower(), val, filters, joins)
-        where_clause = " AND ".join(filters)
-        join_clause = " ".join(joins)
-        sql = (
-            f"select image.* from image {join_clause} "
-            f"{'where' if where_clause else ''} {where_clause}"
-        )
-        with utils.DbCursor() as crs:
-            crs.execute(sql)
-        return crs.fetchall()
+                mthd(comp.lower(), val, filters, joins, params)
+        return " ".join(joins), " AND ".join(filters), params
 
     @classmethod
-    def _filter_keywords(cls, comp, val, filters, joins):
-        comp_expr = 'not ' if 'does not contain' in comp.lower() else ''
-        terms = val.split(" ")
-        parts = []
-        for term in terms:
-            # Need to double-escape backslashes as they are used in two f-strings.
-            parts.append(f"image.keywords {comp_expr}regexp '\\\\b{term}\\\\b'")
-        compound_filter = f"({' OR '.join(parts)})"
-        filters.append(compound_filter)
+    def _filter_keywords(cls, comp, val, filters, joins, params):
+        terms = utils.split_keywords(val)
+        if not terms:
+            return
+        if "does not contain" in comp.lower():
+            # Images that are missing at least one of the terms
+            filters.append(
+                """image.pkid not in (select image_id from image_keyword
+                    where keyword in %s
+                    group by image_id having count(*) = %s)"""
+            )
+            params.extend([terms, len(terms)])
+        else:
+            # Images that have any of the terms
+            filters.append("image.pkid in (select image_id from image_keyword where keyword in %s)")
+            params.append(terms)
 
     @classmethod
-    def _filter_name(cls, comp, val, filters, joins):
+    def _filter_name(cls, comp, val, filters, joins, params):
         if comp == "equals":
-            clause = f"image.name = '{val}'"
+            clause = "image.name = %s"
         elif comp == "starts with":
-            clause = f"image.name like '{val}%'"
+            clause = "image.name like concat(%s, '%%')"
         elif comp == "ends with":
-            clause = f"image.name like '%{val}'"
+            clause = "image.name like concat('%%', %s)"
         elif comp == "contains":
-            clause = f"image.name like '%{val}%'"
+            clause = "image.name like concat('%%', %s, '%%')"
         filters.append(clause)
+        params.append(val)
 
     @classmethod
-    def _filter_orientation(cls, comp, val, filters, joins):
-        filters.append(f"image.orientation = '{comp[0].upper()}'")
+    def _filter_orientation(cls, comp, val, filters, joins, params):
+        filters.append("image.orientation = %s")
+        params.append(comp[0].upper())
 
     @classmethod
-    def _filter_created(cls, comp, val, filters, joins):
+    def _filter_created(cls, comp, val, filters, joins, params):
         dateval = date_parser.parse(val)
         datestr = dateval.strftime("%Y-%m-%d %H:%M:%S")
         if comp == "equals":
-            clause = f"image.created like '{datestr}%'"
+            clause = "image.created like concat(%s, '%%')"
         elif comp == "before":
-            clause = f"image.created < '{datestr}'"
+            clause = "image.created < %s"
         elif comp == "after":
-            clause = f"image.created > '{datestr}'"
+            clause = "image.created > %s"
         elif comp == "on or before":
-            clause = f"image.created <= '{datestr}'"
+            clause = "image.created <= %s"
         elif comp == "on or after":
-            clause = f"image.created >= '{datestr}'"
+            clause = "image.created >= %s"
         filters.append(clause)
+        params.append(datestr)
 
     @classmethod
-    def _filter_year(cls, comp, val, filters, joins):
-        filters.append(f"year(image.created) = '{comp}'")
+    def _filter_year(cls, comp, val, filters, joins, params):
+        filters.append("year(image.created) = %s")
+        params.append(comp)
 
     @classmethod
-    def _filter_album(cls, comp, val, filters, joins):
-        joins.append("join album_image on image.pkid = album_image.image_id")
-        filters.append(f"album_image.album_id {'!' if 'not a member' in comp else ''}= '{val}'")
+    def _filter_album(cls, comp, val, filters, joins, params):
+        # Membership is tested with a subquery rather than a join, so that the smart
+        # album's own rows in album_image don't match the rule.
+        negate = "not " if "not a member" in comp else ""
+        filters.append(
+            f"image.pkid {negate}in (select image_id from album_image where album_id = %s)"
+        )
+        params.append(val)
 
     def update_images(self, image_ids):
         utils.debugout("UPD IMG CALLED")
         if self.smart:
-            images = self.smart_album_images(self.pkid, return_objects=True)
-            image_ids = [img.pkid for img in images]
+            # The rules have changed, so recalculate the whole album
+            added, removed = self.refresh_smart_membership()
         else:
             current_ids = set(self.image_ids)
             selected_ids = set(image_ids)
@@ -407,96 +741,175 @@ class Album(Base):
             to_add = selected_ids.difference(current_ids)
             utils.debugout("TOREMOVE", len(to_remove))
             utils.debugout("TOADD", len(to_add))
-            self.remove_images(to_remove)
-            self.add_images(to_add)
+            added, removed = self.update_membership(add=to_add, remove=to_remove)
+        if not (added or removed):
+            return
         utils.debugout("CALLING UPDATE_FRAME_ALBUM")
-        self.update_frame_album(image_ids)
+        self.update_frame_album(added, removed)
+
+    def update_membership(self, add=None, remove=None):
+        """Adds and removes images from this album in bulk. Both add and remove
+        are lists of Image objects or their IDs. The existence of every image
+        being added is checked with a single query, and all the changes to
+        album_image are made in a single transaction. Raises NotFound if any
+        of the images being added doesn't exist. Returns the sets of image IDs
+        that were actually added and removed.
+
+        This does not update the frames using the album; callers that change
+        many images should do that once, after all the changes are made.
+        """
+        add_ids = {_image_id(img) for img in add or []}
+        remove_ids = {_image_id(img) for img in remove or []}.difference(add_ids)
+        with utils.DbCursor() as crs:
+            if add_ids:
+                sql = """select image.pkid, album_image.album_id from image
+                        left join album_image on album_image.image_id = image.pkid
+                            and album_image.album_id = %s
+                        where image.pkid in %s"""
+                crs.execute(sql, (self.pkid, list(add_ids)))
+                recs = crs.fetchall()
+                missing = add_ids.difference(rec["pkid"] for rec in recs)
+                if missing:
+                    raise exc.NotFound("Images not found: {}".format(", ".join(sorted(missing))))
+                # Don't add any that are already in the album
+                add_ids = {rec["pkid"] for rec in recs if not rec["album_id"]}
+            if remove_ids:
+                sql = "delete from album_image where album_id = %s and image_id in %s;"
+                crs.execute(sql, (self.pkid, list(remove_ids)))
+            if add_ids:
+                sql = "insert into album_image (album_id, image_id) values (%s, %s);"
+                crs.executemany(sql, [(self.pkid, img_id) for img_id in add_ids])
+            if add_ids or remove_ids:
+                changed_album_ids = {self.pkid}
+                changed_album_ids.update(self._rebalance_sub_albums(crs, add_ids, remove_ids))
+                sql = "update album set images_version = images_version + 1 where pkid in %s;"
+                crs.execute(sql, (sorted(changed_album_ids),))
+        utils.debugout("Updated images in", self, "added", len(add_ids), "removed", len(remove_ids))
+        return add_ids, remove_ids
+
+    def _rebalance_sub_albums(self, crs, add_ids, remove_ids):
+        """Applies a batch of additions to and removals from this album to its
+        sub-albums, if any, keeping their image counts within one of each
+        other. The sub-album membership is loaded once and all the moves are
+        worked out in memory, then written using the caller's cursor. Returns
+        the IDs of the sub-albums that changed.
+        """
+        sql = """select album.pkid, album_image.image_id from album
+                left join album_image on album_image.album_id = album.pkid
+                where album.parent_id = %s"""
+        crs.execute(sql, (self.pkid,))
+        recs = crs.fetchall()
+        if not recs:
+            return set()
+        membership = {}
+        for rec in recs:
+            images = membership.setdefault(rec["pkid"], set())
+            if rec["image_id"]:
+                images.add(rec["image_id"])
+        allocator = SubAlbumAllocator(membership)
+        for img_id in remove_ids:
+            allocator.remove(img_id)
+        for img_id in add_ids:
+            allocator.add(img_id)
+        allocator.rebalance()
+        adds, removes = allocator.changes()
+        utils.debugout("SUB ALBUM CHANGES", len(adds), "added", len(removes), "removed")
+        if removes:
+            sql = "delete from album_image where (album_id, image_id) in %s;"
+            crs.execute(sql, (removes,))
+        if adds:
+            sql = "insert into album_image (album_id, image_id) values (%s, %s);"
+            crs.executemany(sql, adds)
+        return {album_id for album_id, img_id in adds + removes}
 
     def add_images(self, img_list):
-        for img in img_list:
-            self.add_image(img)
+        self.update_membership(add=img_list)
 
     def add_image(self, img):
-        img_obj = Image.get(img)
-        utils.debugout("Adding image to", self)
-        sql = "insert into album_image (album_id, image_id) values (%s, %s);"
-        with utils.DbCursor() as crs:
-            crs.execute(sql, (self.pkid, img_obj.pkid))
-        self._allocate_to_sub_albums(img_obj)
-
-    def _allocate_to_sub_albums(self, img_obj):
-        utils.debugout("ALLOC CALLED", len(self.sub_albums))
-        if not self.sub_albums:
-            return
-        albums_by_image_count = sorted([ab for ab in self.sub_albums], key=lambda x: x.image_count)
-        utils.debugout("ALBBYCOUNT", albums_by_image_count)
-        # Add the new image to the first album in the list; it will have image_count <= the others
-        utils.debugout("ADDING IMAGE TO", albums_by_image_count[0])
-        albums_by_image_count[0].add_image(img_obj)
+        self.update_membership(add=[img])
 
     def remove_images(self, img_list):
-        for img in img_list:
-            self.remove_image(img)
+        self.update_membership(remove=img_list)
 
     def remove_image(self, img):
-        img_obj = Image.get(img)
-        sql = "delete from album_image where album_id = %s and image_id = %s;"
-        with utils.DbCursor() as crs:
-            crs.execute(sql, (self.pkid, img_obj.pkid))
-        self._deallocate_from_sub_albums(img_obj)
-
-    def _deallocate_from_sub_albums(self, img_obj):
-        utils.debugout("DEALLOC CALLED", len(self.sub_albums))
-        if not self.sub_albums:
-            return
-        try:
-            sub_album_with_image = [ab for ab in self.sub_albums if img_obj.pkid in ab.image_ids][0]
-        except IndexError:
-            # No sub_album has that image
-            return
-        counts = [ab.image_count for ab in self.sub_albums]
-        min_cnt, max_cnt = min(counts), max(counts)
-        album_in_max_cnt_group = sub_album_with_image.image_count == max_cnt
-        # First remove the image
-        sub_album_with_image.remove_image(img_obj)
-        if not album_in_max_cnt_group:
-            # We need to  move an image from one of the albums with max_cnt.
-            max_albums = [ab for ab in self.sub_albums if ab.image_count == max_cnt]
-            max_album = random.choice(max_albums)
-            image_to_move = random.choice(max_album.images)
-            max_album.remove_image(image_to_move)
-            sub_album_with_image.add_image(image_to_move)
+        self.update_membership(remove=[img])
+
+    # Frames are sent an album's images using a versioned protocol. Every change to the
+    # album's images increments its images_version (see update_membership()). Usually
+    # the frames are sent just the change, under their 'images_delta' key, as
+    # {"version": N, "add": [names], "remove": [names]}. A frame applies it if it has
+    # version N - 1; otherwise it has missed something, and fetches the full list from
+    # /frames/<pkid>/images. Every SNAPSHOT_INTERVAL versions, or when the change is
+    # large, the full list is sent instead, under the 'images' key, with the version
+    # under 'images_version'.
+    SNAPSHOT_INTERVAL = 20
+    MAX_DELTA_SIZE = 200
 
     def set_frame_album(self, frame_id):
         utils.debugout("SET_FRAME_ALBUM called")
-        image_names = []
-        if self.image_ids:
-            sql = "select name from image where pkid in %s;"
-            with utils.DbCursor() as crs:
-                crs.execute(sql, (self.image_ids,))
-            image_names = [rec["name"] for rec in crs.fetchall()]
-        utils.write_key(frame_id, "images", image_names)
+        self._write_image_snapshot([frame_id], self.images_version)
         utils.debugout("Wrote images for frame_id =", frame_id)
 
-    def update_frame_album(self, image_ids=None):
-        """Updates the 'images' key for all frames that are linked to the album."""
-        image_ids = image_ids or self.image_ids
-        utils.debugout("UPDATE_FRAME_ALBUM called, image_ids=", image_ids)
+    def update_frame_album(self, added=None, removed=None):
+        """Sends the latest change to the album's images to all the frames that are
+        linked to the album. `added` and `removed` are the IDs of the images that
+        changed; if neither is given, or if it's time for a snapshot, the frames are
+        sent the full list of images.
+        """
         sql = "select pkid from frame where album_id = %s;"
         with utils.DbCursor() as crs:
             count = crs.execute(sql, (self.pkid,))
             utils.debugout("FRAME COUNT", count)
             frame_ids = [rec["pkid"] for rec in crs.fetchall()]
-            utils.debugout(
-                "Album.update_frame_album; frame_ids=", frame_ids, "album_id =", self.pkid
-            )
-            if frame_ids:
-                sql = "select name from image where pkid in %s;"
-                crs.execute(sql, (image_ids,))
-                image_names = [rec["name"] for rec in crs.fetchall()]
-                for frame_id in frame_ids:
-                    utils.write_key(frame_id, "images", image_names)
-                    utils.debugout("Wrote images for frame_id =", frame_id)
+            sql = "select images_version from album where pkid = %s;"
+            crs.execute(sql, (self.pkid,))
+            self.images_version = crs.fetchone()["images_version"]
+        utils.debugout("Album.update_frame_album; frame_ids=", frame_ids, "album_id =", self.pkid)
+        if not frame_ids:
+            return
+        added = set(added or [])
+        removed = set(removed or [])
+        num_changes = len(added) + len(removed)
+        if (
+            not num_changes
+            or num_changes > self.MAX_DELTA_SIZE
+            or self.images_version % self.SNAPSHOT_INTERVAL == 0
+        ):
+            self._write_image_snapshot(frame_ids, self.images_version)
+            return
+        sql = "select pkid, name from image where pkid in %s;"
+        with utils.DbCursor() as crs:
+            crs.execute(sql, (list(added | removed),))
+        names = {rec["pkid"]: rec["name"] for rec in crs.fetchall()}
+        delta = {
+            "version": self.images_version,
+            "add": sorted(names[pkid] for pkid in added if pkid in names),
+            "remove": sorted(names[pkid] for pkid in removed if pkid in names),
+        }
+        # All the frames get the same change, so publish it to them together
+        utils.after_commit(utils.write_keys, frame_ids, "images_delta", delta)
+
+    @classmethod
+    def image_names_for_version(cls, pkid, version):
+        """Returns the names of the album's images, reading them from the database only
+        when `version` differs from the images_version they were cached at. A `version`
+        of None means that the album doesn't exist, as when a frame's album has been
+        deleted, and returns an empty list.
+        """
+        if version is None:
+            _album_image_names.pop(pkid, None)
+            return []
+        cached_version, image_names = _album_image_names.get(pkid, (_NOT_CACHED, None))
+        if cached_version != version:
+            image_names = cls(pkid=pkid).image_names
+            _album_image_names[pkid] = (version, image_names)
+        return image_names
+
+    def _write_image_snapshot(self, frame_ids, version):
+        # The list and its version are written together, so that a frame never caches
+        # one list under the other's version
+        values = {"images": self.image_names, "images_version": version}
+        utils.after_commit(utils.write_topics, frame_ids, values)
 
     @classmethod
     def default_album_id(cls):
@@ -533,28 +946,31 @@ class Frame(Base):
     _write_keys = True
 
     @classmethod
-    def _after_get(cls, rec):
-        """We need to add the frameset name, if any, to the record."""
-        sql = """select frameset.name
-                from frameset
-                where frameset.pkid = %s;"""
+    def _framesets_for(cls, recs):
+        """Returns the frameset records for the frames in `recs`, keyed by their pkid."""
+        frameset_ids = {rec["frameset_id"] for rec in recs if rec["frameset_id"]}
+        if not frameset_ids:
+            return {}
+        sql = "select pkid, name, album_id from frameset where pkid in %s;"
         with utils.DbCursor() as crs:
-            crs.execute(sql, (rec["frameset_id"],))
-        name_rec = crs.fetchone()
-        rec["frameset_name"] = name_rec.get("name") if name_rec else ""
+            crs.execute(sql, (list(frameset_ids),))
+        return {rec["pkid"]: rec for rec in crs.fetchall()}
+
+    @classmethod
+    def _preload(cls, recs):
+        """We need to add the frameset name, if any, to the records."""
+        framesets = cls._framesets_for(recs)
+        for rec in recs:
+            frameset = framesets.get(rec["frameset_id"])
+            rec["frameset_name"] = frameset["name"] if frameset else ""
 
     @classmethod
     def _after_list(cls, recs):
-        sql = """select frame.pkid, frameset.name, frameset.album_id
-                from frame join frameset on frame.frameset_id = frameset.pkid;"""
-        with utils.DbCursor() as crs:
-            crs.execute(sql)
-        frameset_name_recs = crs.fetchall()
-        name_mapping = {rec["pkid"]: rec["name"] for rec in frameset_name_recs}
-        album_mapping = {rec["pkid"]: rec["album_id"] for rec in frameset_name_recs}
+        framesets = cls._framesets_for(recs)
         for rec in recs:
-            rec["frameset_name"] = name_mapping.get(rec["pkid"], "-none-")
-            rec["album_id"] = album_mapping.get(rec["pkid"], rec["album_id"])
+            frameset = framesets.get(rec["frameset_id"])
+            rec["frameset_name"] = frameset["name"] if frameset else "-none-"
+            rec["album_id"] = frameset["album_id"] if frameset else rec["album_id"]
             rec["freespace"] = utils.human_fmt(rec["freespace"])
 
     def _after_save(self):
@@ -583,7 +999,34 @@ class Frame(Base):
             "log_level",
         )
         settings_dict = {setting: safe_json(setting) for setting in settings}
-        utils.write_key(self.pkid, "settings", settings_dict)
+        utils.after_commit(utils.write_key, self.pkid, "settings", settings_dict)
+
+    @classmethod
+    def register(cls, pkid, ip, freespace):
+        """Records a frame that has just started up. New frames are inserted with the
+        default settings; for existing frames only the ip and freespace are updated.
+        Returns the frame and the images_version of its album.
+        """
+        new_frame = cls(pkid=pkid, ip=ip, freespace=freespace)
+        field_names = new_frame.db_field_names
+        values = tuple([str(getattr(new_frame, field)) for field in field_names])
+        sql = """insert into frame ({}) values ({})
+                on duplicate key update ip = values(ip), freespace = values(freespace);
+                """.format(
+            ", ".join(field_names), ", ".join(["%s"] * len(field_names))
+        )
+        with utils.DbCursor() as crs:
+            crs.execute(sql, values)
+            sql = """select frame.*, album.images_version
+                    from frame left join album on album.pkid = frame.album_id
+                    where frame.pkid = %s;"""
+            crs.execute(sql, (pkid,))
+        rec = crs.fetchone()
+        images_version = rec.pop("images_version")
+        frame = cls(**rec)
+        frame._loaded = {fld: rec[fld] for fld in frame.db_field_names if fld in rec}
+        frame._after_save()
+        return frame, images_version
 
     def set_album(self, album_obj_or_id):
         if isinstance(album_obj_or_id, Album):
@@ -619,20 +1062,16 @@ class Frameset(Base):
     non_db_fields = ["num_frames"]
 
     @classmethod
-    def _after_get(self, rec):
-        """Add the frame count."""
-        sql = "select frame.pkid from frame where frame.frameset_id = %s;"
-        with utils.DbCursor() as crs:
-            rec["num_frames"] = crs.execute(sql, (self.pkid,))
-
-    @classmethod
-    def _after_list(self, recs):
+    def _preload(cls, recs):
         """Add the frame counts."""
-        sql = "select count(pkid) as num_frames, frameset_id from frame group by frameset_id;"
+        pkids = [rec["pkid"] for rec in recs]
+        if not pkids:
+            return
+        sql = """select frameset_id, count(pkid) as num_frames from frame
+                where frameset_id in %s group by frameset_id;"""
         with utils.DbCursor() as crs:
-            crs.execute(sql)
-        frame_count_recs = crs.fetchall()
-        mapping = {rec["frameset_id"]: rec["num_frames"] for rec in frame_count_recs}
+            crs.execute(sql, (pkids,))
+        mapping = {rec["frameset_id"]: rec["num_frames"] for rec in crs.fetchall()}
         for rec in recs:
             rec["num_frames"] = mapping.get(rec["pkid"], 0)
 
@@ -641,19 +1080,19 @@ class Frameset(Base):
         self.remove_sub_albums()
         for child in self.child_frames:
             self.remove_frame(child)
-        for frame_id in frame_ids:
-            self.add_frame(frame_id)
+        for child in Frame.get_many(frame_ids):
+            self.add_frame(child)
         self.assign_sub_albums()
 
     def remove_frame(self, child):
-        child_obj = Frame.get(child)
+        child_obj = child if isinstance(child, Frame) else Frame.get(child)
         child_obj.frameset_id = None
         # We also need to blank their album_id
         child_obj.album_id = None
         child_obj.save()
 
     def add_frame(self, child):
-        child_obj = Frame.get(child)
+        child_obj = child if isinstance(child, Frame) else Frame.get(child)
         if child_obj.frameset_id:
             if child_obj.frameset_id != self.pkid:
                 # Frame belongs to a different frameset
@@ -696,7 +1135,7 @@ class Frameset(Base):
         with utils.DbCursor() as crs:
             crs.execute(sql, (self.pkid,))
         frame_ids = [rec["pkid"] for rec in crs.fetchall()]
-        return [Frame.get(frame_id) for frame_id in frame_ids]
+        return Frame.get_many(frame_ids)
 
     @property
     def child_frame_ids(self):
@@ -716,24 +1155,68 @@ class Image(Base):
     orientation: str = ""
     imgtype: str = "JPEG"
     size: int = 0
+    content_hash: str = None
     created: datetime = datetime.utcnow()
     updated: datetime = datetime.utcnow()
 
     table_name = "image"
     custom_list = True
+    page_key = ("name", "pkid")
 
     @classmethod
     def _custom_where(cls, **kwargs):
-        where = ""
+        wheres = []
+        vals = []
         orient = kwargs.get("orientation")
         keywords = kwargs.get("keywords")
         if orient:
-            where = f" image.orientation = '{orient}' "
-        if keywords:
-            words = [" keywords REGEXP '\\\\b%s\\\\b' " % word for word in keywords.split()]
-            filt_clause = " and ".join(words)
-            if where:
-                where = f"{where} {filt_clause}"
-            else:
-                where = filt_clause
-        return where
+            wheres.append("image.orientation = %s")
+            vals.append(orient)
+        words = utils.split_keywords(keywords)
+        if words:
+            # Images that have every one of the words
+            placeholders = ", ".join(["%s"] * len(words))
+            wheres.append(
+                f"""image.pkid in (select image_id from image_keyword
+                    where keyword in ({placeholders})
+                    group by image_id having count(*) = %s)"""
+            )
+            vals.extend(words)
+            vals.append(len(words))
+        return " and ".join(wheres), tuple(vals)
+
+    def _after_save(self):
+        with utils.DbCursor() as crs:
+            self.index_keywords(crs, self.pkid, self.keywords)
+        Album.refresh_smart_albums_for_image(self.pkid)
+
+    @classmethod
+    def _after_delete(cls, pkid):
+        with utils.DbCursor() as crs:
+            cls.index_keywords(crs, pkid, "")
+
+    @staticmethod
+    def index_keywords(crs, pkid, keywords):
+        """Updates the image_keyword rows for an image to match the words in
+        its keywords string, and adjusts the keyword_vocab counts for any
+        words that were added or removed. Call this with the cursor used to
+        write the keywords so that all the changes are committed together.
+        """
+        crs.execute("select keyword from image_keyword where image_id = %s", (pkid,))
+        old_words = {rec["keyword"] for rec in crs.fetchall()}
+        new_words = set(utils.split_keywords(keywords))
+        removed = sorted(old_words - new_words)
+        added = sorted(new_words - old_words)
+        if removed:
+            sql = "delete from image_keyword where image_id = %s and keyword = %s"
+            crs.executemany(sql, [(pkid, word) for word in removed])
+            sql = "update keyword_vocab set image_count = image_count - 1 where keyword = %s"
+            crs.executemany(sql, [(word,) for word in removed])
+            sql = "delete from keyword_vocab where keyword in %s and image_count <= 0"
+            crs.execute(sql, (removed,))
+        if added:
+            sql = "insert into image_keyword (image_id, keyword) values (%s, %s)"
+            crs.executemany(sql, [(pkid, word) for word in added])
+            sql = """insert into keyword_vocab (keyword, image_count) values (%s, 1)
+                    on duplicate key update image_count = image_count + 1"""
+            crs.executemany(sql, [(word,) for word in added])
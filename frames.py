@@ -1,10 +1,15 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+import collections
 from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
+import hashlib
 import json
+import os
 import sys
+import threading
+import time
 
 from flask import Flask, abort, g, make_response, redirect, render_template
 from flask import request, session, url_for
@@ -17,11 +22,337 @@ import utils
 from utils import debugout
 
 LOG = utils.LOG
+# The serialized status for each frame, as a tuple of (ETag, body)
+_status_cache = {}
+# Seconds to wait for a frame to say what it is displaying
+CURRENT_IMAGE_TIMEOUT = 10
+# The values that a frame's heartbeat can report, and their types
+HEARTBEAT_FIELDS = {"freespace": int, "current_image": str, "uptime": int, "temperature": Decimal}
+HEARTBEAT_BUFFER_SIZE = 4096
+# Seconds between writes of the buffered heartbeats to the DB
+HEARTBEAT_FLUSH_INTERVAL = 15
+
+
+class HeartbeatBuffer:
+    """Collects the heartbeats that frames send to this worker.
+
+    The most recent heartbeats are kept in a ring buffer of `size` entries. Every
+    `flush_interval` seconds a background thread writes the latest heartbeat of each
+    frame that has reported since the last flush to the frame_heartbeat table, in a
+    single multi-row upsert, and copies the freespace and ip to the frame table. Each
+    worker has its own buffer, so a row is only replaced by a heartbeat that was
+    received after it. If the process has forked, the child starts with an empty buffer
+    and its own thread.
+    """
+
+    def __init__(self, size=HEARTBEAT_BUFFER_SIZE, flush_interval=HEARTBEAT_FLUSH_INTERVAL):
+        self.size = size
+        self.flush_interval = flush_interval
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._recent = collections.deque(maxlen=self.size)
+        self._latest = {}
+        # IDs of the frames whose latest heartbeat hasn't been written to the DB
+        self._pending = set()
+        self._thread = None
+
+    def _check_pid(self):
+        if os.getpid() != self.pid:
+            self._reset()
+
+    def record(self, frame_id, ip, **values):
+        """Adds a heartbeat to the buffer, and returns it."""
+        self._check_pid()
+        heartbeat = dict.fromkeys(HEARTBEAT_FIELDS)
+        heartbeat.update(values, frame_id=frame_id, ip=ip, received=datetime.utcnow())
+        with self._lock:
+            self._recent.append(heartbeat)
+            self._latest[frame_id] = heartbeat
+            self._pending.add(frame_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return heartbeat
+
+    def latest(self, frame_id):
+        """Returns the frame's latest heartbeat, or None. This is the newer of the one in
+        this worker's buffer and the one in the DB, which may have been written by
+        another worker since.
+        """
+        self._check_pid()
+        with self._lock:
+            buffered = self._latest.get(frame_id)
+        sql = "select * from frame_heartbeat where frame_id = %s;"
+        with utils.DbCursor() as crs:
+            crs.execute(sql, (frame_id,))
+        stored = crs.fetchone()
+        if not (buffered and stored):
+            return buffered or stored
+        return buffered if buffered["received"] > stored["received"] else stored
+
+    def recent(self, frame_id):
+        """Returns the heartbeats from the frame that are still in the ring buffer, oldest
+        first.
+        """
+        self._check_pid()
+        with self._lock:
+            return [hb for hb in self._recent if hb["frame_id"] == frame_id]
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception("Failed to write the frame heartbeats")
+
+    def flush(self):
+        """Writes the latest heartbeat from each frame that has reported since the last
+        flush to the DB. Returns the number of frames written.
+        """
+        with self._lock:
+            heartbeats = [self._latest[frame_id] for frame_id in self._pending]
+            self._pending = set()
+        if not heartbeats:
+            return 0
+        # Another worker may have written a newer heartbeat for the frame, so only replace
+        # older rows. 'received' must be the last column, as MySQL makes the assignments
+        # in order, and the others compare against its old value.
+        columns = ["frame_id", "ip", *HEARTBEAT_FIELDS, "received"]
+        sql = """insert into frame_heartbeat ({}) values ({})
+                on duplicate key update {};""".format(
+            ", ".join(columns),
+            ", ".join(["%s"] * len(columns)),
+            ", ".join(
+                "{0} = if(values(received) >= received, values({0}), {0})".format(col)
+                for col in columns[1:]
+            ),
+        )
+        vals = [tuple(hb[col] for col in columns) for hb in heartbeats]
+        frame_ids = [hb["frame_id"] for hb in heartbeats]
+        try:
+            with utils.DbCursor() as crs:
+                # pymysql sends this as a single multi-row insert
+                crs.executemany(sql, vals)
+                # Only copy the heartbeats that weren't older than the stored ones
+                sql = """update frame join frame_heartbeat on frame_heartbeat.frame_id = frame.pkid
+                        set frame.ip = frame_heartbeat.ip,
+                          frame.freespace = coalesce(frame_heartbeat.freespace, frame.freespace)
+                        where (frame_heartbeat.frame_id, frame_heartbeat.received) in %s;"""
+                crs.execute(sql, ([(hb["frame_id"], hb["received"]) for hb in heartbeats],))
+        except Exception:
+            # Try again on the next flush, unless there's a newer heartbeat by then
+            with self._lock:
+                self._pending.update(frame_ids)
+            raise
+        return len(heartbeats)
+
+
+heartbeats = HeartbeatBuffer()
+
+# The topics that carry commands to a frame. A command is pending until the frame
+# deletes its key, acknowledges it, or (for current_display) answers it.
+FRAME_COMMAND_TOPICS = ("reboot", "restart_screen", "change_photo", "current_display")
+# The topics that frames write to report on themselves
+FRAME_STATE_TOPICS = ("state", "current_image")
+# The number of unresolved commands and current_display requests to keep track of
+FRAME_STATE_MAX_TRACKED = 10000
+# Seconds to wait before re-connecting when the watch fails
+FRAME_STATE_RETRY_INTERVAL = 5
+
+
+class FrameStateCache:
+    """Keeps an in-memory copy of the state of each frame, from the frame keys in etcd.
+
+    A background thread reads all the keys once, and then watches them, so that the
+    frame views can show each frame's last reported state, the image it is showing, and
+    its pending commands without any etcd reads of their own. The thread is started by
+    the first call to `get()`, and again in a forked child.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._states = {}
+        # Maps (command_id, frame_id) for commands, and (request_id, None) for
+        # current_display requests, to (frame_id, topic)
+        self._tracked = collections.OrderedDict()
+        # Maps the command_id of a broadcast command to the ID of its etcd lease
+        self._command_leases = collections.OrderedDict()
+        self._thread = None
+
+    def start(self):
+        if os.getpid() != self.pid:
+            self._reset()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def get(self, frame_id):
+        """Returns the cached state of the frame, as a dict with the keys 'state',
+        'current_image' and 'pending'.
+        """
+        self.start()
+        with self._lock:
+            state = self._states.get(frame_id)
+            if state is None:
+                return self._new_state()
+            return dict(state, pending=dict(state["pending"]))
+
+    @staticmethod
+    def _new_state():
+        return {"state": None, "current_image": None, "pending": {}}
+
+    def _run(self):
+        while True:
+            try:
+                start_revision = self.load()
+                self.watch(start_revision)
+            except Exception:
+                LOG.exception("The frame state watch failed")
+            time.sleep(FRAME_STATE_RETRY_INTERVAL)
+
+    @staticmethod
+    def wanted(full_key):
+        """Returns True if the key is one that the cache uses: a frame's state or command
+        topic, a broadcast command's record, an acknowledgement, or an answer to a request.
+        """
+        topic = full_key.partition(":")[2]
+        return (
+            topic in FRAME_COMMAND_TOPICS + FRAME_STATE_TOPICS
+            or topic in ("", "command")
+            or topic.startswith("ack/")
+        )
+
+    def load(self):
+        """Lists the keys without their values, and then reads the values of just the
+        keys that the cache uses, in as few transactions as possible, so that the frames'
+        image lists aren't read. Returns the revision to start watching from.
+        """
+        clt = utils._get_etcd_client()
+        last_revision = 0
+        keys = []
+        for value, meta in clt.get_prefix("/", keys_only=True):
+            last_revision = max(last_revision, meta.mod_revision)
+            full_key = str(meta.key, "UTF-8")
+            if self.wanted(full_key):
+                keys.append(full_key)
+        for pos in range(0, len(keys), utils.ETCD_MAX_TXN_OPS):
+            chunk = keys[pos : pos + utils.ETCD_MAX_TXN_OPS]
+            ops = [clt.transactions.get(key) for key in chunk]
+            succeeded, responses = clt.transaction(compare=[], success=ops, failure=[])
+            for full_key, kvs in zip(chunk, responses):
+                # A key that has been deleted since it was listed has no values
+                for value, meta in kvs:
+                    self.apply(full_key, value)
+        return last_revision + 1 if last_revision else None
+
+    def watch(self, start_revision=None):
+        """Applies the changes to the keys. The keys begin with the frame or command ID,
+        so etcd can't limit the watch to the topics that the cache uses; the events for
+        other keys, such as the image lists, are dropped without decoding them.
+        """
+        clt = utils._get_etcd_client()
+        kwargs = {"start_revision": start_revision} if start_revision else {}
+        events_iterator, cancel = clt.watch_prefix("/", **kwargs)
+        for event in events_iterator:
+            full_key = str(event.key, "UTF-8")
+            if not self.wanted(full_key):
+                continue
+            if isinstance(event, utils.etcd3.events.DeleteEvent):
+                self.apply(full_key, None)
+            else:
+                self.apply(full_key, event.value)
+                self.attach_ack_lease(full_key, event)
+
+    def attach_ack_lease(self, full_key, event):
+        """Attaches a command's acknowledgement to the command's lease, if the frame didn't,
+        so that it expires along with the command. The watch sees the command's record
+        before any of its acknowledgements. Each worker's cache sees the same event, so the
+        key is only written if it hasn't changed since; the first worker to write it wins.
+        """
+        uuid, _, topic = full_key.lstrip("/").partition(":")
+        if not topic.startswith("ack/"):
+            return
+        with self._lock:
+            lease_id = self._command_leases.get(uuid)
+        if not lease_id or event.lease == lease_id:
+            return
+        clt = utils._get_etcd_client()
+        try:
+            clt.transaction(
+                compare=[clt.transactions.mod(full_key) == event.mod_revision],
+                success=[clt.transactions.put(full_key, event.value, lease=lease_id)],
+                failure=[],
+            )
+        except utils.etcd3.exceptions.Etcd3Exception as e:
+            LOG.error(f"Failed to attach key '{full_key}' to lease {lease_id}: {e}")
+
+    def apply(self, full_key, value):
+        """Updates the states for a key that has been written, or deleted if `value` is
+        None.
+        """
+        if not self.wanted(full_key):
+            return
+        uuid, _, topic = full_key.lstrip("/").partition(":")
+        data = json.loads(value) if value is not None else None
+        with self._lock:
+            if topic in FRAME_STATE_TOPICS:
+                self._frame_state(uuid)[topic] = data
+            elif topic == "command":
+                if data is None:
+                    self._command_leases.pop(uuid, None)
+                    return
+                self._command_leases[uuid] = data.get("lease")
+                while len(self._command_leases) > FRAME_STATE_MAX_TRACKED:
+                    self._command_leases.popitem(last=False)
+            elif topic in FRAME_COMMAND_TOPICS:
+                pending = self._frame_state(uuid)["pending"]
+                if data is None:
+                    pending.pop(topic, None)
+                    return
+                pending[topic] = data
+                if topic == "current_display" and isinstance(data, str):
+                    self._track((data, None), uuid, topic)
+                elif isinstance(data, dict) and "command_id" in data:
+                    # A broadcast command has the same command_id for every frame
+                    self._track((data["command_id"], uuid), uuid, topic)
+            elif data is not None:
+                # An acknowledgement of a command, under 'ack/<frame_id>', or a frame's
+                # answer to a current_display request under the request_id.
+                ack_frame_id = topic[len("ack/") :] if topic else None
+                frame_id, topic = self._tracked.pop((uuid, ack_frame_id), (None, None))
+                if frame_id is None:
+                    return
+                state = self._frame_state(frame_id)
+                state["pending"].pop(topic, None)
+                if topic == "current_display":
+                    state["current_image"] = data
+
+    def _frame_state(self, frame_id):
+        return self._states.setdefault(frame_id, self._new_state())
+
+    def _track(self, tracking_key, frame_id, topic):
+        self._tracked[tracking_key] = (frame_id, topic)
+        while len(self._tracked) > FRAME_STATE_MAX_TRACKED:
+            self._tracked.popitem(last=False)
+
+
+frame_states = FrameStateCache()
 
 
 def GET_list():
     frames = entities.Frame.list()
     g.frames = sorted([frm.to_dict() for frm in frames], key=lambda x: x["name"].upper())
+    for frm in g.frames:
+        frm.update(frame_states.get(frm["pkid"]))
     albums = entities.Album.list()
     g.albums = sorted(
         [ab.to_dict() for ab in albums if not ab.parent_id],
@@ -41,25 +372,14 @@ def register_frame():
     rf = request.form
     debugout("FORM", rf)
     pkid = rf["pkid"]
-    try:
-        frame = entities.Frame.get(pkid)
-        debugout("EXISTING FRAME", frame)
-    except exc.NotFound:
-        # New frame
-        frame = entities.Frame(pkid=pkid)
-        debugout("NEW FRAME", frame)
-    frame.ip = request.remote_addr
-    frame.freespace = rf["freespace"]
-    debugout("BEFORE FRAME SAVE")
-    frame.save(new=True)
-    debugout("AFTER FRAME SAVE")
+    frame, images_version = entities.Frame.register(pkid, request.remote_addr, rf["freespace"])
+    debugout("REGISTERED FRAME", frame)
     agent = request.headers.get("User-agent")
     debugout("Album:", frame.album_id)
     if agent == "photoviewer":
         # from the frame app; return the pkid and images
         if frame.album_id:
-            album = entities.Album.get(frame.album_id)
-            image_names = album.image_names
+            image_names = entities.Album.image_names_for_version(frame.album_id, images_version)
         else:
             image_names = []
         return json.dumps([frame.pkid, image_names])
@@ -69,6 +389,7 @@ def register_frame():
 
 def show_frame(frame_id):
     g.frame = entities.Frame.get(frame_id).to_dict()
+    g.frame.update(frame_states.get(frame_id))
     return render_template("frame_detail.html", human_fmt=utils.human_fmt)
 
 
@@ -100,10 +421,11 @@ def update(pkid=None):
     itype = rfc.pop("interval_type", "variance")
     rfc["use_halflife"] = itype.lower() == "halflife"
     pkid = rfc["pkid"] = rfc["pkid"] or pkid
-    frame_dict = entities.Frame.get(pkid).to_dict()
-    frame_dict.update(rfc)
-    frame = entities.Frame(**frame_dict)
-    utils.debugout("FRAMEDICT", frame_dict)
+    frame = entities.Frame.get(pkid)
+    for fld, val in rfc.items():
+        setattr(frame, fld, val)
+    utils.debugout("FRAMEDICT", frame.to_dict())
+    # Only the changed fields are written, without reading the record again
     frame.save()
     return redirect(url_for("index"))
 
@@ -120,14 +442,72 @@ def restart_screen(pkid):
     return redirect(url_for("index"))
 
 
+def heartbeat(pkid):
+    """Records a heartbeat from a frame. The values may be sent as JSON or as form data;
+    any that are left out are stored as NULL.
+    """
+    data = request.get_json(silent=True) or request.form
+    values = {}
+    for fld, typ in HEARTBEAT_FIELDS.items():
+        val = data.get(fld)
+        if val in (None, ""):
+            continue
+        try:
+            values[fld] = typ(val)
+        except (ValueError, ArithmeticError):
+            abort(400, "Invalid value for '{}': {}".format(fld, val))
+    heartbeats.record(pkid, request.remote_addr, **values)
+    return "", 204
+
+
+def latest_heartbeat(pkid):
+    """Returns the frame's latest heartbeat, from this worker's buffer or from the DB,
+    whichever is newer.
+    """
+    hb = heartbeats.latest(pkid)
+    if hb is None:
+        abort(404)
+    hb = dict(hb, received=hb["received"].isoformat())
+    return json.dumps(hb, cls=DecimalEncoder)
+
+
 def get_current_frame_image(pkid):
+    """Asks the frame what it is displaying. Normally this waits for the frame to
+    answer. If the 'wait' query parameter is 0, it returns a request_id right away
+    instead, and the answer can be collected from current_frame_image_result().
+    """
     request_id = utils.gen_uuid()
-    print("REQUESTING FRAME IMAGE", request_id)
+    LOG.debug(f"Requesting current image from frame '{pkid}'; request_id={request_id}")
     utils.write_key(pkid, "current_display", request_id)
-    ret = utils.read_key(request_id)
+    if request.args.get("wait", "1").lower() in ("0", "false", "no"):
+        return json.dumps({"request_id": request_id}), 202
+    return utils.read_key(request_id, timeout=CURRENT_IMAGE_TIMEOUT)
+
+
+def current_frame_image_result(request_id):
+    """Returns the frame's answer to a get_current_frame_image() request, or a 202
+    response if it hasn't answered yet.
+    """
+    ret = utils.peek_key(request_id)
+    if ret is None:
+        return json.dumps({"request_id": request_id, "status": "PENDING"}), 202
     return ret
 
 
+def image_snapshot(pkid):
+    """Returns the full list of images for the frame's album, along with the album's
+    images_version. Frames call this when they find that they have missed a change.
+    """
+    try:
+        frame = entities.Frame.get(pkid)
+    except exc.NotFound:
+        abort(404)
+    if not frame.album_id:
+        return json.dumps({"version": 0, "images": []})
+    album = entities.Album.get(frame.album_id)
+    return json.dumps({"version": album.images_version, "images": album.image_names})
+
+
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, Decimal):
@@ -136,38 +516,54 @@ class DecimalEncoder(json.JSONEncoder):
 
 
 def status(pkid):
-    crs = utils.get_cursor()
+    """Returns the frame's settings and images as JSON. The response has an ETag built
+    from the settings and the album's images_version, so a frame that sends it back in
+    If-None-Match gets a 304 when nothing has changed, without the album's images
+    being read. The body for each frame is kept in a cache keyed by that ETag.
+    """
     sql = """
-            select name, description, use_halflife, interval_time, interval_units, album_id,
-              brightness, contrast, saturation
-            from frame where pkid = %s;
+            select frame.name, frame.description, frame.use_halflife, frame.interval_time,
+              frame.interval_units, frame.album_id, frame.brightness, frame.contrast,
+              frame.saturation, album.images_version
+            from frame left join album on album.pkid = frame.album_id
+            where frame.pkid = %s;
             """
-    crs.execute(sql, (pkid,))
-    recs = crs.fetchall()
-    if not recs:
+    with utils.DbCursor() as crs:
+        crs.execute(sql, (pkid,))
+    rec = crs.fetchone()
+    if not rec:
         return ""
-    rec = recs[0]
-    name = rec["name"]
-    description = rec["description"]
-    interval_time = rec["interval_time"]
-    interval_units = rec["interval_units"]
-    album_id = rec["album_id"]
-    brightness = rec["brightness"]
-    contrast = rec["contrast"]
-    saturation = rec["saturation"]
-    # Get associated images
-    album_id = rec["album_id"]
-    album = entities.Album.get(album_id)
+    etag = hashlib.md5(json.dumps(rec, cls=DecimalEncoder, sort_keys=True).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        resp = make_response("", 304)
+    else:
+        cached_etag, body = _status_cache.get(pkid, (None, None))
+        if cached_etag != etag:
+            body = _status_body(rec)
+            _status_cache[pkid] = (etag, body)
+        resp = make_response(body)
+        resp.mimetype = "application/json"
+    resp.set_etag(etag)
+    # Frames may keep the response, but must check that it's still current
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+def _status_body(rec):
+    if rec["album_id"]:
+        image_names = entities.Album.image_names_for_version(rec["album_id"], rec["images_version"])
+    else:
+        image_names = []
     return json.dumps(
         {
-            "name": name,
-            "description": description,
-            "interval_time": interval_time,
-            "interval_units": interval_units,
-            "brightness": brightness,
-            "contrast": contrast,
-            "saturation": saturation,
-            "images": album.image_names,
+            "name": rec["name"],
+            "description": rec["description"],
+            "interval_time": rec["interval_time"],
+            "interval_units": rec["interval_units"],
+            "brightness": rec["brightness"],
+            "contrast": rec["contrast"],
+            "saturation": rec["saturation"],
+            "images": image_names,
         },
         cls=DecimalEncoder,
     )
@@ -2,6 +2,7 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 from dataclasses import dataclass
 from datetime import datetime
+import json
 
 from flask import (
     Flask,
@@ -20,6 +21,13 @@ import entities
 import frames
 import utils
 
+# The commands that can be sent to all the frames in a frameset, and the etcd topic for each
+COMMAND_TOPICS = {
+    "reboot": "reboot",
+    "restart_screen": "restart_screen",
+    "navigate": "change_photo",
+}
+
 
 def GET_list():
     crs = utils.get_cursor()
@@ -112,3 +120,48 @@ def manage_frames_POST(frameset_id):
     fs = entities.Frameset.get(frameset_id)
     fs.set_frames(frame_ids)
     return redirect("/framesets")
+
+
+def send_command(frameset_id):
+    """Sends a command to every frame in the frameset with a single etcd transaction, and
+    returns the command_id that its progress can be followed with.
+    """
+    command = request.form.get("command", "")
+    topic = COMMAND_TOPICS.get(command)
+    if not topic:
+        abort(400, "Unknown command: '{}'".format(command))
+    value = request.form.get("value", "now")
+    frame_ids = entities.Frameset(pkid=frameset_id).child_frame_ids
+    if not frame_ids:
+        abort(404, "There are no frames in frameset '{}'".format(frameset_id))
+    command_id, results = utils.broadcast_command(frame_ids, topic, value)
+    failed = [
+        frame_id
+        for frame_id in frame_ids
+        if not results.get(utils.BASE_KEY.format(uuid=frame_id, topic=topic))
+    ]
+    return json.dumps({"command_id": command_id, "frames": frame_ids, "failed": failed}), 202
+
+
+def command_status(frameset_id, command_id):
+    """Returns the acknowledgements received for a command sent by send_command(), and the
+    frames that have yet to answer. Commands that weren't sent to this frameset's frames
+    aren't found.
+    """
+    command = utils.peek_key(command_id, "command")
+    if command is None:
+        abort(404)
+    frame_ids = set(entities.Frameset(pkid=frameset_id).child_frame_ids)
+    if not frame_ids.issuperset(command["frames"]):
+        abort(404)
+    acks = utils.command_acks(command_id)
+    pending = [frame_id for frame_id in command["frames"] if frame_id not in acks]
+    return json.dumps(
+        {
+            "command_id": command_id,
+            "topic": command["topic"],
+            "acknowledged": acks,
+            "pending": pending,
+            "complete": not pending,
+        }
+    )
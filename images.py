@@ -1,6 +1,10 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import hashlib
+import json
 import os
 import shutil
+import tempfile
 
 from flask import (
     abort,
@@ -15,23 +19,28 @@ from flask import (
 )
 from flask import url_for
 from PIL import Image
-from werkzeug.utils import secure_filename
+from werkzeug.utils import safe_join, secure_filename
 
 import entities
+import ingest
+import thumbnails
 import utils
 
 IMAGE_FOLDER = "/var/www/photoserver/"
+# Folders queued for import through the web interface must be inside this one
+IMPORT_FOLDER = "/var/www/photoserver_import/"
 DEFAULT_IMAGES = {"H": "default_h.jpg", "V": "default_v.jpg"}
 CREATE_DATE_KEY = 36867
+# The EXIF tag for the sub-IFD that holds CREATE_DATE_KEY
+EXIF_IFD_KEY = 0x8769
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of content hashes written to the database at a time by backfill_hashes()
+HASH_BATCH_SIZE = 500
 
 
 def GET_list(orient=None, filt=None, clear=None, page_size=None):
     orient = orient or "A"
-    try:
-        offset = int(orient)
-        orient = g.orient if hasattr(g, "orient") else "A"
-    except ValueError:
-        offset = 0
+    if orient not in ("H", "V", "S", "A"):
         orient = "A"
     orient_order = "HVSAH"
     orient_pos = orient_order.index(orient)
@@ -42,28 +51,22 @@ def GET_list(orient=None, filt=None, clear=None, page_size=None):
     else:
         kwargs = {}
 
-    g.image_offset = offset or (g.image_offset if hasattr(g, "image_offset") else 0)
-    page_size = page_size or utils.DEFAULT_PAGE_SIZE
-    change = (-1 * page_size) if request.form.get("back") else page_size
-    kwargs["offset"] = g.image_offset
-    kwargs["page_size"] = page_size
-    kwargs["count"] = True
-    g.image_offset += change
     if clear:
         filt = ""
         session.pop("keywords", "")
-        kwargs["keywords"] = ""
     else:
         filt = filt or session.get("keywords", "")
         if filt:
             kwargs["keywords"] = filt
     session["keywords"] = g.keywords = filt
-    images = entities.Image.list(**kwargs)
-    g.image_count = len(images)
-    g.image_offset = max(min(g.image_offset, g.image_count), 0)
-    g.last_image = g.image_offset >= g.image_count
-    g.images = [img.to_dict() for img in images]
-    #    list_db_images(orient=g.orient, filt=filt)
+    # Changing the filter starts over at the first page
+    page_token = None if (clear or request.form.get("filter")) else request.args.get("page")
+    page_size = page_size or utils.DEFAULT_PAGE_SIZE
+    page = entities.Image.list_page(page_size=page_size, page_token=page_token, **kwargs)
+    g.image_count = entities.Image.count(**kwargs)
+    g.next_page = page.next_token
+    g.prev_page = page.prev_token
+    g.images = [img.to_dict() for img in page.items]
     for img in g.images:
         img["size"] = utils.human_fmt(img["size"])
     g.thumb_path = os.path.join(IMAGE_FOLDER, "thumbs")
@@ -98,6 +101,8 @@ def update_list():
             continue
         with utils.DbCursor() as crs:
             crs.execute(sql, (new_val, pkid))
+            entities.Image.index_keywords(crs, pkid, new_val)
+        entities.Album.refresh_smart_albums_for_image(pkid)
     return GET_list()
 
 
@@ -114,6 +119,15 @@ def update():
             where pkid = %s; """
     with utils.DbCursor() as crs:
         crs.execute(sql, (name, keywords, pkid))
+        entities.Image.index_keywords(crs, pkid, keywords)
+        if name != orig_name:
+            # The albums' lists of image names have changed
+            sql = """
+                    update album join album_image on album_image.album_id = album.pkid
+                    set album.images_version = album.images_version + 1
+                    where album_image.image_id = %s; """
+            crs.execute(sql, (pkid,))
+    entities.Album.refresh_smart_albums_for_image(pkid)
     if name != orig_name:
         _rename_image(orig_name, name)
     return redirect(url_for("list_images"))
@@ -123,10 +137,8 @@ def _rename_image(orig_name, new_name):
     fpath_orig = os.path.join(IMAGE_FOLDER, orig_name)
     fpath_new = os.path.join(IMAGE_FOLDER, new_name)
     shutil.move(fpath_orig, fpath_new)
-    # Move the thumbnail file, too
-    tpath_orig = os.path.join(IMAGE_FOLDER, "thumbs", orig_name)
-    tpath_new = os.path.join(IMAGE_FOLDER, "thumbs", new_name)
-    shutil.move(tpath_orig, tpath_new)
+    # Move the thumbnail and other renditions, too
+    thumbnails.rename_renditions(orig_name, new_name)
 
 
 def delete(pkid=None):
@@ -142,14 +154,20 @@ def delete(pkid=None):
         fname = crs.fetchone()["name"]
         sql = "delete from image where pkid = %s"
         crs.execute(sql, (pkid,))
+        sql = """update album join album_image on album_image.album_id = album.pkid
+                set album.images_version = album.images_version + 1
+                where album_image.image_id = %s"""
+        crs.execute(sql, (pkid,))
         sql = "delete from album_image where image_id = %s"
         crs.execute(sql, (pkid,))
+        entities.Image.index_keywords(crs, pkid, "")
     # Now delete the file, if it is present
     fpath = os.path.join(IMAGE_FOLDER, fname)
     try:
         os.unlink(fpath)
     except OSError:
         pass
+    thumbnails.remove_renditions(fname)
     return redirect(url_for("list_images"))
 
 
@@ -165,6 +183,89 @@ def isduplicate(name):
     return bool(res)
 
 
+def file_hash(fpath):
+    """Returns the SHA-256 hex digest of the file's contents."""
+    hasher = hashlib.sha256()
+    with open(fpath, "rb") as ff:
+        for chunk in iter(lambda: ff.read(UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def find_by_hash(content_hash, cursor=None):
+    """Returns the pkid and name of an image whose contents have this SHA-256 hex
+    digest, or None if there isn't one.
+    """
+    sql = "select pkid, name from image where content_hash = %s order by created limit 1;"
+    if cursor:
+        cursor.execute(sql, (content_hash.lower(),))
+        return cursor.fetchone()
+    with utils.DbCursor() as crs:
+        crs.execute(sql, (content_hash.lower(),))
+    return crs.fetchone()
+
+
+def hash_lookup(content_hash):
+    """Lets another app check whether the server already has an image before sending
+    it.
+    """
+    if len(content_hash) != 64:
+        abort(400, "Expected a SHA-256 hex digest")
+    rec = find_by_hash(content_hash)
+    if not rec:
+        abort(404)
+    return json.dumps(rec)
+
+
+def _hash_path(fpath):
+    try:
+        return file_hash(fpath)
+    except OSError:
+        return None
+
+
+def backfill_hashes(img_dir=None, workers=None, report=print):
+    """Computes the content hash for each image that doesn't have one yet, in parallel,
+    and saves them in batches. Returns the number of images hashed, and a list of
+    (name, name) pairs of images with the same contents; the second of each pair is left
+    without a hash.
+    """
+    img_dir = img_dir or IMAGE_FOLDER
+    with utils.DbCursor() as crs:
+        crs.execute("select pkid, name from image where content_hash is null;")
+        recs = crs.fetchall()
+        crs.execute("select name, content_hash from image where content_hash is not null;")
+        seen = {rec["content_hash"]: rec["name"] for rec in crs.fetchall()}
+    paths = [os.path.join(img_dir, rec["name"]) for rec in recs]
+    sql = "update image set content_hash = %s where pkid = %s;"
+    batch = []
+    hashed = 0
+    duplicates = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = executor.map(_hash_path, paths, chunksize=16)
+        for rec, content_hash in zip(recs, hashes):
+            if content_hash is None:
+                report("Could not read '{}'".format(rec["name"]))
+                continue
+            if content_hash in seen:
+                # content_hash is unique, so a duplicate's hash is left NULL
+                duplicates.append((seen[content_hash], rec["name"]))
+                continue
+            seen[content_hash] = rec["name"]
+            batch.append((content_hash, rec["pkid"]))
+            if len(batch) >= HASH_BATCH_SIZE:
+                with utils.DbCursor() as crs:
+                    crs.executemany(sql, batch)
+                hashed += len(batch)
+                report("Hashed {} of {} images".format(hashed, len(recs)))
+                batch = []
+    if batch:
+        with utils.DbCursor() as crs:
+            crs.executemany(sql, batch)
+        hashed += len(batch)
+    return hashed, duplicates
+
+
 def upload_thumb():
     """Used when another app has uploaded the main file to the cloud, and is
     sending the thumb for local display.
@@ -176,6 +277,73 @@ def upload_thumb():
     return "OK"
 
 
+def save_upload(stream, folder=None):
+    """Writes an uploaded file to a temporary file in the image folder, hashing it as it
+    goes. Returns the temporary file's path, the SHA-256 hex digest, and the size.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload-", dir=folder or IMAGE_FOLDER)
+    try:
+        # mkstemp() makes the file readable only by its owner
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as ff:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                ff.write(chunk)
+                size += len(chunk)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path, hasher.hexdigest(), size
+
+
+def image_info(fpath):
+    """Reads the image's header, without decoding it, and returns a dict with its
+    'imgtype', 'width', 'height', 'orientation' and 'created' date. If the image has no
+    EXIF creation date, as with PNGs, 'created' is the file's modification time, so that
+    the image still sorts by date. Raises IOError if the file isn't an image.
+    """
+    with Image.open(fpath) as img_obj:
+        width, height = img_obj.size
+        exif = img_obj.getexif()
+        created = exif.get_ifd(EXIF_IFD_KEY).get(CREATE_DATE_KEY)
+        return {
+            "imgtype": img_obj.format,
+            "width": width,
+            "height": height,
+            "orientation": utils.orientation_for_size(width, height),
+            "created": created or datetime.fromtimestamp(os.stat(fpath).st_mtime),
+        }
+
+
+def add_image_record(crs, fname, info, size, keywords, content_hash=None):
+    """Saves the info for a new image file, as returned by image_info(), in the
+    database. Returns the new image's pkid.
+    """
+    pkid = utils.gen_uuid()
+    sql = """
+            insert into image (pkid, keywords, name, orientation, width,
+                height, imgtype, size, content_hash, created, updated)
+            values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s); """
+    vals = (
+        pkid,
+        keywords,
+        fname,
+        info["orientation"],
+        info["width"],
+        info["height"],
+        info["imgtype"],
+        size,
+        content_hash,
+        info["created"],
+        datetime.now(),
+    )
+    crs.execute(sql, vals)
+    entities.Image.index_keywords(crs, pkid, keywords)
+    return pkid
+
+
 def upload_file():
     image = request.files["image_file"]
     fname = secure_filename(image.filename)
@@ -183,54 +351,119 @@ def upload_file():
     if isduplicate(fname):
         flash("Image already exists!!", "error")
         return redirect(url_for("upload_image_form"))
-    fpath = os.path.join(IMAGE_FOLDER, fname)
-    image.save(fpath)
+    tmp_path, content_hash, size = save_upload(image.stream)
+    existing = find_by_hash(content_hash)
+    if existing:
+        flash("This image has already been uploaded as '{}'".format(existing["name"]), "error")
+        os.unlink(tmp_path)
+        return redirect(url_for("upload_image_form"))
     try:
-        img_obj = Image.open(fpath)
+        info = image_info(tmp_path)
     except IOError:
         flash("Not a valid image", "err")
-        os.unlink(fpath)
+        os.unlink(tmp_path)
         return redirect(url_for("upload_image_form"))
-    imgtype = img_obj.format
-
-    orientation = utils.get_img_orientation(fpath)
-    width, height = img_obj.size
+    fpath = os.path.join(IMAGE_FOLDER, fname)
+    os.replace(tmp_path, fpath)
     rf = request.form
     keywords = rf["file_keywords"] or fname
-    size = os.stat(fpath).st_size
-    created = img_obj._getexif().get(CREATE_DATE_KEY)
-    updated = datetime.fromtimestamp(os.stat(fpath).st_ctime)
-
-    # Make a thumbnail
-    thumb_size = (120, 120)
-    img_obj.thumbnail(thumb_size)
-    thumb_path_parts = list(os.path.split(fpath))
-    thumb_path_parts.insert(-1, "thumbs")
-    thumb_path = os.path.join(*thumb_path_parts)
     try:
-        img_obj.save(thumb_path, format=imgtype)
-    except Exception as e:
-        print("EXCEPTION", e)
-
-    # Save the info in the database
-    pkid = utils.gen_uuid()
-    sql = """
-            insert into image (pkid, keywords, name, orientation, width,
-                height, imgtype, size, created, updated)
-            values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s); """
-    vals = (pkid, keywords, fname, orientation, width, height, imgtype, size, created, updated)
-    with utils.DbCursor() as crs:
-        crs.execute(sql, vals)
+        with utils.DbCursor() as crs:
+            pkid = add_image_record(crs, fname, info, size, keywords, content_hash)
+    except utils.IntegrityError:
+        # The same contents were uploaded at the same time
+        flash("This image has already been uploaded", "error")
+        os.unlink(fpath)
+        return redirect(url_for("upload_image_form"))
+    entities.Album.refresh_smart_albums_for_image(pkid)
+    # The thumbnail and the other renditions are made in the background
+    thumbnails.queue_renditions(fpath)
 
     return redirect(url_for("list_images"))
 
 
+def import_folder_path(folder):
+    """Returns the real path of `folder`, a path relative to IMPORT_FOLDER, or None if
+    it isn't a folder inside IMPORT_FOLDER.
+    """
+    root = os.path.realpath(IMPORT_FOLDER)
+    fpath = safe_join(root, folder or "")
+    if not fpath:
+        return None
+    # safe_join() doesn't follow symlinks, so check where the folder really is
+    fpath = os.path.realpath(fpath)
+    if os.path.commonpath([root, fpath]) != root or not os.path.isdir(fpath):
+        return None
+    return fpath
+
+
+def ingest_folder():
+    """Queues the image files in a folder under IMPORT_FOLDER to be imported by the
+    ingest workers, and returns the batch_id for following their progress.
+    """
+    folder = import_folder_path(request.form.get("folder"))
+    if not folder:
+        abort(400, "'folder' must be a folder in the import folder")
+    keywords = request.form.get("keywords") or None
+    batch_id, added = ingest.enqueue_folder(folder, keywords=keywords)
+    return json.dumps({"batch_id": batch_id, "queued": added}), 202
+
+
+def ingest_progress(batch_id):
+    summary = ingest.progress(batch_id)
+    if not summary["total"]:
+        abort(404)
+    return json.dumps(summary)
+
+
 def download(img_name):
+    """Sends the image. If either of the 'w' and 'h' query parameters are given, a copy
+    resized to that size is sent instead. The 'fit' parameter can be 'contain' (the
+    default), to fit the image within the size, or 'cover', to fill it and crop the
+    rest; 'q' sets the JPEG quality. The copy is made from the smallest rendition that
+    is large enough, and is cached.
+    """
     if img_name in DEFAULT_IMAGES.values():
-        directory = "."
-    else:
-        directory = IMAGE_FOLDER
-    return send_from_directory(directory, img_name)
+        return send_from_directory(".", img_name)
+    req_width = request.args.get("w", type=int)
+    req_height = request.args.get("h", type=int)
+    if not (req_width or req_height):
+        return send_from_directory(IMAGE_FOLDER, img_name)
+    fit = request.args.get("fit", "contain")
+    quality = request.args.get("q", type=int)
+    if fit not in thumbnails.FIT_MODES:
+        abort(400, "'fit' must be one of: {}".format(", ".join(thumbnails.FIT_MODES)))
+    if fit == "cover" and not (req_width and req_height):
+        abort(400, "Both 'w' and 'h' are needed with 'fit=cover'")
+    for val in (req_width, req_height):
+        if val is not None and not 0 < val <= thumbnails.MAX_RESIZE_DIMENSION:
+            abort(400, "The size must be from 1 to {}".format(thumbnails.MAX_RESIZE_DIMENSION))
+    if quality is not None and not 1 <= quality <= 95:
+        abort(400, "'q' must be from 1 to 95")
+    fpath = safe_join(IMAGE_FOLDER, img_name)
+    if not fpath or not os.path.isfile(fpath):
+        abort(404)
+    source = None
+    sql = "select width, height from image where name = %s"
+    with utils.DbCursor() as crs:
+        crs.execute(sql, (img_name,))
+    rec = crs.fetchone()
+    if rec:
+        rendition = thumbnails.pick_rendition(
+            rec["width"],
+            rec["height"],
+            req_width or rec["width"],
+            req_height or rec["height"],
+            fit=fit,
+        )
+        if rendition:
+            rendition_path = os.path.join(thumbnails.rendition_folder(rendition), img_name)
+            if os.path.exists(rendition_path):
+                source = rendition_path
+    cache_path = thumbnails.resized_image(
+        img_name, req_width, req_height, fit=fit, quality=quality, source=source
+    )
+    return send_from_directory(*os.path.split(cache_path))
 
 
 def set_album():
@@ -265,4 +498,6 @@ def set_album():
         # Now add the image to the album
         sql = "insert into album_image (album_id, image_id) values (%s, %s) ;"
         crs.execute(sql, (album_id, image_id))
+        sql = "update album set images_version = images_version + 1 where pkid = %s"
+        crs.execute(sql, (album_id,))
     return "Success!"
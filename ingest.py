@@ -0,0 +1,365 @@
+"""A persistent queue for importing batches of image files.
+
+Files copied to a folder are queued with `enqueue_folder()`, one job per file, in the
+ingest_job table. Each job goes through the STAGES in order:
+
+    register: move the file into the image folder and create its image record
+    renditions: make the thumbnail and the other renditions
+
+Worker processes, started with `run_workers()` or `python ingest.py work`, claim jobs
+from the table and run their current stage. A stage that fails is retried, with an
+increasing delay, up to MAX_ATTEMPTS times before the job is marked as failed. At most
+STAGE_CONCURRENCY[stage] jobs run a stage at once, across all the workers. While a job
+runs, its worker refreshes its claim every CLAIM_REFRESH_INTERVAL seconds; a job whose
+claim hasn't been refreshed for CLAIM_TIMEOUT seconds is assumed to belong to a worker
+that died, and is run again.
+
+Each job has an idempotency key made from the file's name, size and mtime, so queueing
+the same files again doesn't import them twice. A file whose contents match an image
+that is already on the server, under any name, isn't imported at all: its job is linked
+to the existing image and marked as done.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+import entities
+import images
+import thumbnails
+import utils
+
+LOG = logging.getLogger("photo")
+STAGES = ("register", "renditions")
+STAGE_CONCURRENCY = {"register": 2, "renditions": os.cpu_count() or 1}
+MAX_ATTEMPTS = 3
+# Seconds before the first retry of a failed stage; it doubles with each attempt
+RETRY_DELAY = 10
+CLAIM_TIMEOUT = 600
+CLAIM_REFRESH_INTERVAL = CLAIM_TIMEOUT // 4
+# Seconds for a worker to wait before looking for more jobs when there are none to run
+POLL_INTERVAL = 2
+
+
+class PermanentError(Exception):
+    """Raised by a stage when retrying it can't help."""
+
+    pass
+
+
+def idempotency_key(fpath):
+    stat = os.stat(fpath)
+    val = "{}|{}|{}".format(os.path.basename(fpath), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha256(val.encode("utf-8")).hexdigest()
+
+
+def enqueue_folder(folder, keywords=None, batch_id=None):
+    """Queues a job for each file in the folder. Files that have been queued before are
+    skipped. Returns the batch_id, and the number of jobs that were added.
+    """
+    batch_id = batch_id or utils.gen_uuid()
+    rows = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            rows.append(
+                (
+                    utils.gen_uuid(),
+                    batch_id,
+                    idempotency_key(entry.path),
+                    entry.path,
+                    keywords,
+                    STAGES[0],
+                )
+            )
+    if not rows:
+        return batch_id, 0
+    sql = """insert ignore into ingest_job
+                (pkid, batch_id, idempotency_key, fpath, keywords, stage, run_after, created)
+            values (%s, %s, %s, %s, %s, %s, now(), now());"""
+    with utils.DbCursor() as crs:
+        added = crs.executemany(sql, rows)
+    return batch_id, added
+
+
+def claim_job(worker_id):
+    """Claims the oldest job that is ready to run, in a stage that is below its
+    concurrency limit, and returns its record. Returns None if there is nothing to run.
+    Claims are made one at a time, under a DB lock, so that the limits hold across all
+    the workers.
+    """
+    with utils.DbCursor() as crs:
+        crs.execute("select get_lock('ingest_job_claim', 10) as locked;")
+        if not crs.fetchone()["locked"]:
+            return None
+        try:
+            # Release the jobs of workers that have died
+            sql = """update ingest_job set status = 'pending'
+                    where status = 'running'
+                    and claimed_at < now() - interval %s second;"""
+            crs.execute(sql, (CLAIM_TIMEOUT,))
+            sql = """select stage, count(*) as running from ingest_job
+                    where status = 'running' group by stage;"""
+            crs.execute(sql)
+            running = {rec["stage"]: rec["running"] for rec in crs.fetchall()}
+            stages = [stage for stage in STAGES if running.get(stage, 0) < STAGE_CONCURRENCY[stage]]
+            if not stages:
+                return None
+            sql = """select * from ingest_job
+                    where status = 'pending' and stage in %s and run_after <= now()
+                    order by created limit 1;"""
+            crs.execute(sql, (stages,))
+            job = crs.fetchone()
+            if not job:
+                return None
+            sql = """update ingest_job
+                    set status = 'running', claimed_by = %s, claimed_at = now(),
+                      attempts = attempts + 1
+                    where pkid = %s;"""
+            crs.execute(sql, (worker_id, job["pkid"]))
+            job["attempts"] += 1
+            job["claimed_by"] = worker_id
+            return job
+        finally:
+            # The claim must be committed before another worker can get the lock
+            crs.connection.commit()
+            crs.execute("select release_lock('ingest_job_claim');")
+
+
+def _refresh_claim(job, stopped):
+    sql = """update ingest_job set claimed_at = now()
+            where pkid = %s and claimed_by = %s and status = 'running';"""
+    while not stopped.wait(CLAIM_REFRESH_INTERVAL):
+        try:
+            with utils.DbCursor() as crs:
+                crs.execute(sql, (job["pkid"], job["claimed_by"]))
+        except Exception as e:
+            LOG.warning("Could not refresh the claim on ingest job %s: %s", job["pkid"], e)
+
+
+@contextlib.contextmanager
+def _claim_kept(job):
+    """Keeps the job's claim from timing out while the block runs, so that a long stage
+    isn't taken for the job of a dead worker and run a second time.
+    """
+    stopped = threading.Event()
+    threading.Thread(target=_refresh_claim, args=(job, stopped), daemon=True).start()
+    try:
+        yield
+    finally:
+        stopped.set()
+
+
+def run_job(job):
+    """Runs the job's current stage, and records the outcome."""
+    stage = job["stage"]
+    try:
+        with _claim_kept(job):
+            finished = STAGE_HANDLERS[stage](job)
+    except Exception as e:
+        permanent = isinstance(e, PermanentError) or job["attempts"] >= MAX_ATTEMPTS
+        LOG.warning("Ingest job %s failed at stage '%s': %s", job["pkid"], stage, e)
+        if permanent:
+            sql = """update ingest_job set status = 'failed', last_error = %s
+                    where pkid = %s;"""
+            vals = (str(e), job["pkid"])
+        else:
+            delay = RETRY_DELAY * 2 ** (job["attempts"] - 1)
+            sql = """update ingest_job set status = 'pending', last_error = %s,
+                      run_after = now() + interval %s second
+                    where pkid = %s;"""
+            vals = (str(e), delay, job["pkid"])
+        with utils.DbCursor() as crs:
+            crs.execute(sql, vals)
+        return False
+    next_stage = STAGES.index(stage) + 1
+    if next_stage < len(STAGES) and not finished:
+        sql = """update ingest_job set stage = %s, status = 'pending', attempts = 0,
+                  last_error = NULL, run_after = now()
+                where pkid = %s;"""
+        vals = (STAGES[next_stage], job["pkid"])
+    else:
+        sql = "update ingest_job set status = 'done', last_error = NULL where pkid = %s;"
+        vals = (job["pkid"],)
+    with utils.DbCursor() as crs:
+        crs.execute(sql, vals)
+    return True
+
+
+def _link_duplicate(job, content_hash):
+    """If an image with the same contents already exists, links the job to it instead
+    of importing the file again, and returns True.
+    """
+    existing = images.find_by_hash(content_hash)
+    if not existing:
+        return False
+    LOG.info("'%s' is the same image as '%s'; not importing it", job["fpath"], existing["name"])
+    with utils.DbCursor() as crs:
+        sql = "update ingest_job set image_id = %s, duplicate = 1 where pkid = %s;"
+        crs.execute(sql, (existing["pkid"], job["pkid"]))
+    job["image_id"] = existing["pkid"]
+    job["duplicate"] = 1
+    return True
+
+
+def _register(job):
+    """Moves the file into the image folder and creates its image record. The record's
+    ID is saved to the job in the same transaction, so a retry never creates a second
+    record. Returns True if the file was a duplicate of an existing image, so the job
+    has nothing left to do.
+    """
+    if job["image_id"]:
+        # The record was saved, or the job was linked to an existing image, but the job
+        # wasn't moved on to its next stage
+        return bool(job["duplicate"])
+    fname = secure_filename(os.path.basename(job["fpath"]))
+    dest = os.path.join(images.IMAGE_FOLDER, fname)
+    if os.path.exists(job["fpath"]):
+        content_hash = images.file_hash(job["fpath"])
+        if _link_duplicate(job, content_hash):
+            return True
+        if images.isduplicate(fname):
+            raise PermanentError("An image named '{}' already exists".format(fname))
+        if os.path.exists(dest) and not os.path.samefile(job["fpath"], dest):
+            raise PermanentError("The file '{}' is already in the image folder".format(fname))
+        try:
+            info = images.image_info(job["fpath"])
+        except IOError:
+            raise PermanentError("'{}' is not a valid image".format(job["fpath"]))
+        shutil.move(job["fpath"], dest)
+    elif os.path.exists(dest):
+        # It was moved by an earlier attempt that failed before its record was saved
+        info = images.image_info(dest)
+        content_hash = images.file_hash(dest)
+    else:
+        raise PermanentError("'{}' no longer exists".format(job["fpath"]))
+    size = os.stat(dest).st_size
+    keywords = job["keywords"] or fname
+    try:
+        with utils.DbCursor() as crs:
+            image_id = images.add_image_record(crs, fname, info, size, keywords, content_hash)
+            sql = "update ingest_job set image_id = %s where pkid = %s;"
+            crs.execute(sql, (image_id, job["pkid"]))
+    except utils.IntegrityError:
+        # Another worker imported the same contents after we checked; put the file back
+        # and link to that image instead
+        shutil.move(dest, job["fpath"])
+        if _link_duplicate(job, content_hash):
+            return True
+        raise
+    job["image_id"] = image_id
+    entities.Album.refresh_smart_albums_for_image(image_id)
+    return False
+
+
+def _renditions(job):
+    fname = secure_filename(os.path.basename(job["fpath"]))
+    thumbnails.make_renditions(os.path.join(images.IMAGE_FOLDER, fname))
+
+
+STAGE_HANDLERS = {"register": _register, "renditions": _renditions}
+
+
+def _has_work():
+    sql = "select count(*) as num from ingest_job where status in ('pending', 'running');"
+    with utils.DbCursor() as crs:
+        crs.execute(sql)
+    return crs.fetchone()["num"] > 0
+
+
+def work(worker_id=None, forever=False):
+    """Claims and runs jobs until there are none left, or, if `forever` is True, until
+    the process is stopped. Returns the number of jobs run.
+    """
+    worker_id = worker_id or "{}:{}".format(socket.gethostname(), os.getpid())
+    num_run = 0
+    while True:
+        job = claim_job(worker_id)
+        if job is None:
+            if not forever and not _has_work():
+                return num_run
+            time.sleep(POLL_INTERVAL)
+            continue
+        run_job(job)
+        num_run += 1
+
+
+def run_workers(processes=None, forever=False):
+    """Runs `processes` worker processes, by default one per CPU, and waits for them to
+    finish.
+    """
+    processes = processes or os.cpu_count() or 1
+    procs = [
+        multiprocessing.Process(target=work, kwargs={"forever": forever})
+        for num in range(processes)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+def progress(batch_id):
+    """Returns a summary of the jobs in the batch: the number in each stage and status,
+    and the errors for the ones that have failed.
+    """
+    sql = """select stage, status, count(*) as num from ingest_job
+            where batch_id = %s group by stage, status;"""
+    with utils.DbCursor() as crs:
+        crs.execute(sql, (batch_id,))
+        counts = crs.fetchall()
+        sql = """select fpath, stage, last_error from ingest_job
+                where batch_id = %s and status = 'failed';"""
+        crs.execute(sql, (batch_id,))
+        failures = crs.fetchall()
+    total = sum(rec["num"] for rec in counts)
+    by_status = {}
+    by_stage = {}
+    for rec in counts:
+        by_status[rec["status"]] = by_status.get(rec["status"], 0) + rec["num"]
+        if rec["status"] in ("pending", "running"):
+            by_stage[rec["stage"]] = by_stage.get(rec["stage"], 0) + rec["num"]
+    return {
+        "batch_id": batch_id,
+        "total": total,
+        "done": by_status.get("done", 0),
+        "failed": by_status.get("failed", 0),
+        "in_progress": by_stage,
+        "complete": total > 0 and by_status.get("done", 0) + by_status.get("failed", 0) == total,
+        "failures": failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import batches of image files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    enqueue_parser = subparsers.add_parser("enqueue", help="Queue the files in a folder")
+    enqueue_parser.add_argument("folder")
+    enqueue_parser.add_argument("--keywords", help="Keywords for all the images")
+    work_parser = subparsers.add_parser("work", help="Run the worker processes")
+    work_parser.add_argument("--processes", type=int, help="Defaults to one per CPU")
+    work_parser.add_argument("--forever", action="store_true", help="Keep waiting for new jobs")
+    progress_parser = subparsers.add_parser("progress", help="Show a batch's progress")
+    progress_parser.add_argument("batch_id")
+    args = parser.parse_args()
+    if args.command == "enqueue":
+        batch_id, added = enqueue_folder(args.folder, keywords=args.keywords)
+        print("Queued {} files in batch {}".format(added, batch_id))
+    elif args.command == "work":
+        run_workers(args.processes, forever=args.forever)
+    else:
+        print(json.dumps(progress(args.batch_id), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,10 @@ application = app
 # for shorter decorators
 login_required = security.login_required
 
+# One DB connection and transaction per request
+app.after_request(utils.commit_request)
+app.teardown_request(utils.release_request)
+
 
 @app.route("/")
 @app.route("/frames/")
@@ -50,6 +54,17 @@ def show_frame(frame_id):
     return frames.show_frame(frame_id)
 
 
+@app.route("/frames/<pkid>/heartbeat", methods=["POST"])
+def frame_heartbeat(pkid):
+    return frames.heartbeat(pkid)
+
+
+@app.route("/frames/<pkid>/heartbeat")
+@login_required
+def frame_latest_heartbeat(pkid):
+    return frames.latest_heartbeat(pkid)
+
+
 @app.route("/frames/<frame_id>/navigate", methods=["PUT"])
 @login_required
 def navigate_frame(frame_id):
@@ -80,6 +95,12 @@ def get_current_frame_image(frame_id):
     return frames.get_current_frame_image(frame_id)
 
 
+@app.route("/frames/current/<request_id>", methods=["GET"])
+@login_required
+def current_frame_image_result(request_id):
+    return frames.current_frame_image_result(request_id)
+
+
 @app.route("/frames/<frame_id>/album/", methods=["PUT"])
 @app.route("/frames/<frame_id>/album/<album_id>", methods=["PUT"])
 @login_required
@@ -89,12 +110,13 @@ def set_frame_album(frame_id, album_id=None):
 
 @app.route("/frames/<pkid>/status")
 def frame_status(pkid):
-    status = frames.status(pkid)
-    resp = make_response(status)
-    resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    resp.headers["Pragma"] = "no-cache"
-    resp.headers["Expires"] = "0"
-    return resp
+    return frames.status(pkid)
+
+
+@app.route("/frames/<pkid>/images")
+@utils.nocache
+def frame_images(pkid):
+    return frames.image_snapshot(pkid)
 
 
 ### Framesests ###
@@ -129,6 +151,18 @@ def set_frameset_album(frameset_id, album_id=None):
     return framesets.set_album(frameset_id, album_id)
 
 
+@app.route("/framesets/<frameset_id>/commands", methods=["POST"])
+@login_required
+def frameset_command(frameset_id):
+    return framesets.send_command(frameset_id)
+
+
+@app.route("/framesets/<frameset_id>/commands/<command_id>")
+@login_required
+def frameset_command_status(frameset_id, command_id):
+    return framesets.command_status(frameset_id, command_id)
+
+
 @app.route("/framesets/<pkid>/frames", strict_slashes=False)
 @login_required
 def frameset_frames(pkid):
@@ -185,11 +219,29 @@ def upload_file():
     return images.upload_file()
 
 
+@app.route("/images/hash/<content_hash>")
+@login_required
+def image_hash_lookup(content_hash):
+    return images.hash_lookup(content_hash)
+
+
 @app.route("/images/thumb", methods=["POST"])
 def upload_image_thumb():
     return images.upload_thumb()
 
 
+@app.route("/ingest", methods=["POST"])
+@login_required
+def ingest_folder():
+    return images.ingest_folder()
+
+
+@app.route("/ingest/<batch_id>")
+@login_required
+def ingest_progress(batch_id):
+    return images.ingest_progress(batch_id)
+
+
 @app.route("/download/<img_name>", strict_slashes=False)
 def download_file(img_name):
     return images.download(img_name)
@@ -0,0 +1,22 @@
+"""Rebuilds the image_keyword index and the keyword_vocab counts from the
+keywords stored in the image table. The tables are created first if they don't
+exist yet.
+
+    python rebuild_keywords.py          # rebuild both tables
+    python rebuild_keywords.py --vocab  # only recount keyword_vocab
+"""
+import sys
+
+import db_create
+import utils
+
+
+if __name__ == "__main__":
+    with utils.DbCursor() as crs:
+        db_create.upgrade(crs)
+        if "--vocab" in sys.argv:
+            utils.rebuild_keyword_vocab(cursor=crs)
+        else:
+            utils.rebuild_keyword_index(cursor=crs)
+        crs.execute("select count(*) as num_keywords from keyword_vocab;")
+        print("%s keywords in the vocabulary" % crs.fetchone()["num_keywords"])
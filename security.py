@@ -8,8 +8,16 @@ from flask import Response, session
 import utils
 
 TOKEN_DURATION = dt.timedelta(hours=48)
+TOKEN_CACHE_TTL = dt.timedelta(seconds=60)
+TOKEN_CACHE_SIZE = 1000
+PURGE_INTERVAL = dt.timedelta(hours=1)
 LOG = utils.LOG
 
+# Maps the login tokens that this worker has validated to the time until which they
+# can be trusted without checking the DB again.
+_token_cache = {}
+_last_purge = None
+
 
 def _hash_pw(val):
     try:
@@ -34,33 +42,63 @@ def _get_user_token(user_id):
     return token
 
 
+def _prune_token_cache(now):
+    for token, trusted_until in list(_token_cache.items()):
+        if trusted_until <= now:
+            del _token_cache[token]
+    if len(_token_cache) >= TOKEN_CACHE_SIZE:
+        _token_cache.clear()
+
+
+def _token_is_valid(token):
+    """Returns True if the login token hasn't expired. Tokens that have been checked
+    against the DB recently are trusted for up to TOKEN_CACHE_TTL, but never past their
+    expiration. Expired tokens are purged from the DB at most once every PURGE_INTERVAL.
+    """
+    now = dt.datetime.utcnow()
+    trusted_until = _token_cache.get(token)
+    if trusted_until:
+        if trusted_until > now:
+            return True
+        del _token_cache[token]
+    purge_expired_logins()
+    rec = None
+    with utils.DbCursor() as crs:
+        try:
+            crs.execute("SELECT expires FROM login WHERE token = %s;", token)
+            rec = crs.fetchone()
+        except Exception as e:
+            LOG.error("Exception type: {}".format(type(e)))
+            LOG.error("DB Failed: %s", e)
+    if not rec or rec["expires"] <= now:
+        return False
+    if len(_token_cache) >= TOKEN_CACHE_SIZE:
+        _prune_token_cache(now)
+    _token_cache[token] = min(now + TOKEN_CACHE_TTL, rec["expires"])
+    return True
+
+
+def purge_expired_logins(force=False):
+    """Deletes expired tokens from the login table. Unless `force` is True, this only
+    runs once every PURGE_INTERVAL in each worker.
+    """
+    global _last_purge
+    now = dt.datetime.utcnow()
+    if not force and _last_purge and now - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = now
+    with utils.DbCursor() as crs:
+        crs.execute("DELETE FROM login WHERE expires < %s;", (now,))
+
+
 def login_required(fnc):
     @wraps(fnc)
     def wrapped(*args, **kwargs):
-        ok = False
         token = session.get("token")
-        LOG.debug("TOKEN: %s" % token)
-        if token:
-            rec = None
-            with utils.DbCursor() as crs:
-                try:
-                    LOG.debug("Running query SELECT expires FROM login WHERE token = %s;" % token)
-                    crs.execute("SELECT expires FROM login WHERE token = %s;", token)
-                    rec = crs.fetchone()
-                    LOG.debug("DB record for token: %s", rec)
-                except Exception as e:
-                    LOG.error("Exception type: {}".format(type(e)))
-                    LOG.error("DB Failed: %s", e)
-            if rec:
-                LOG.debug("EXPIRES: %s", rec["expires"])
-                LOG.debug("NOW: %s", dt.datetime.utcnow())
-                ok = rec["expires"] > dt.datetime.utcnow()
-                LOG.debug("OK: %s", ok)
-        if not ok:
+        if not (token and _token_is_valid(token)):
             LOG.debug("Login failed for token: %s", token)
             session["original_url"] = request.url
             return redirect("/login_form")
-        LOG.debug("Credentials OK")
         return fnc(*args, **kwargs)
 
     return wrapped
@@ -108,6 +146,7 @@ def POST_login():
         superuser = rec["superuser"]
         token = _get_user_token(user_id)
         flash("Login successful.")
+        purge_expired_logins()
         crs.execute("UPDATE user SET last_login = CURRENT_TIMESTAMP() WHERE pkid = %s", user_id)
     target = session.get("original_url") or "/"
     session["token"] = token
@@ -118,6 +157,7 @@ def POST_login():
 def logout():
     token = session.get("token")
     if token:
+        _token_cache.pop(token, None)
         with utils.DbCursor() as crs:
             crs.execute("DELETE FROM login WHERE token = %s;", token)
     del session["token"]
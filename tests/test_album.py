@@ -1,12 +1,15 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 from collections import defaultdict
+import json
 import random
 
+from mock import patch
 import pytest
 
 import entities
 import exceptions as exc
+import utils
 
 
 @pytest.fixture
@@ -55,6 +58,19 @@ def album_with_20_images_and_sub_albums(album_with_20_images, frameset_with_6_fr
     yield album_obj.pkid
 
 
+@pytest.fixture
+def smart_album_factory(album_factory, test_db_cursor):
+    """Given a name and a list of rules, creates that smart album and returns its ID"""
+
+    def make_smart_album(name, rules):
+        pkid = utils.gen_uuid()
+        sql = "insert into album (pkid, name, smart, rules) values (%s, %s, %s, %s);"
+        test_db_cursor.execute(sql, (pkid, name, True, json.dumps(rules)))
+        return pkid
+
+    return make_smart_album
+
+
 def test_add_image_to_album(image, album_with_random_images):
     album_obj = entities.Album(album_with_random_images)
     orig_count = album_obj.image_count
@@ -70,6 +86,24 @@ def test_remove_image_from_album(album_with_random_images, random_set_of_images)
     assert album_obj.image_count == orig_count - 1
 
 
+def test_update_membership(album_with_random_images, random_set_of_images, set_of_20_images):
+    album_obj = entities.Album(album_with_random_images)
+    to_remove = random_set_of_images[:3]
+    album_obj.update_membership(add=set_of_20_images, remove=to_remove)
+    expected = set(random_set_of_images).union(set_of_20_images).difference(to_remove)
+    assert set(album_obj.image_ids) == expected
+    # Adding images that are already in the album is harmless
+    album_obj.update_membership(add=set_of_20_images)
+    assert album_obj.image_count == len(expected)
+
+
+def test_update_membership_missing_image(album_obj, set_of_20_images):
+    with pytest.raises(exc.NotFound):
+        album_obj.update_membership(add=set_of_20_images + ["no-such-image"])
+    # Nothing should have been added
+    assert album_obj.image_count == 0
+
+
 def test_album_images(album_with_random_images, random_1_to_50):
     album_obj = entities.Album(album_with_random_images)
     images = album_obj.images
@@ -87,6 +121,14 @@ def test_album_image_ids(album_with_random_images, random_1_to_50):
         assert len(img_id) == 36
 
 
+def test_add_image_counts(album_with_random_images, album_factory, random_1_to_50):
+    empty_album = album_factory("empty")
+    recs = [album.to_dict() for album in entities.Album.list()]
+    entities.Album.add_image_counts(recs)
+    counts = {rec["pkid"]: rec["image_count"] for rec in recs}
+    assert counts == {album_with_random_images: random_1_to_50, empty_album: 0}
+
+
 def test_delete_album_by_name(album_factory):
     album_ids = [album_factory(name="album-{}".format(num)) for num in range(10)]
     id_to_delete = random.choice(album_ids)
@@ -174,3 +216,109 @@ def test_album_deallocation(album_with_20_images_and_sub_albums, image_factory):
     assert small_album.image_count == 3
     # Verify that an image was removed from big_album
     assert big_album.image_count == 3
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_smart_album_image_edits(smart_album_factory, image_factory):
+    pkid = smart_album_factory("beaches", [{"keywords": {"contains": "beach"}}])
+    beach = image_factory("beach", keywords="beach sunset")
+    image_factory("forest", keywords="forest")
+    album_obj = entities.Album.get(pkid)
+    assert album_obj.image_ids == [beach]
+    # Editing the image's keywords should take it out of the album
+    beach_obj = entities.Image.get(beach)
+    beach_obj.keywords = "sunset"
+    beach_obj.save()
+    assert album_obj.image_count == 0
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_smart_album_rules_change(smart_album_factory, image_factory):
+    beach = image_factory("beach", keywords="beach")
+    forest = image_factory("forest", keywords="forest")
+    pkid = smart_album_factory("forests", [{"keywords": {"contains": "forest"}}])
+    album_obj = entities.Album.get(pkid)
+    assert album_obj.refresh_smart_membership() == ({forest}, set())
+    assert album_obj.image_ids == [forest]
+    # Nothing changes if the album is refreshed again
+    assert album_obj.refresh_smart_membership() == (set(), set())
+    album_obj.rules = json.dumps([{"keywords": {"contains": "beach forest"}}])
+    assert album_obj.refresh_smart_membership() == ({beach}, set())
+    assert sorted(album_obj.image_ids) == sorted([beach, forest])
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_smart_album_not_a_member_rule(album, smart_album_factory, image_factory):
+    member = image_factory("member")
+    other = image_factory("other")
+    loose = image_factory("loose")
+    other_album = entities.Album.get(album)
+    other_album.add_image(member)
+    pkid = smart_album_factory("outside", [{"album": {"is not a member of": other_album.pkid}}])
+    album_obj = entities.Album.get(pkid)
+    # Images in no album at all match the rule too
+    assert album_obj.refresh_smart_membership() == ({other, loose}, set())
+    # The smart album's own membership doesn't keep an image in it
+    other_album.add_image(other)
+    assert album_obj.refresh_smart_membership() == (set(), {other})
+    assert album_obj.image_ids == [loose]
+
+
+def test_sub_album_allocator_adds_to_smallest():
+    membership = {"a": {"1", "2"}, "b": {"3"}, "c": set()}
+    allocator = entities.SubAlbumAllocator(membership)
+    for img_id in ("4", "5", "6"):
+        allocator.add(img_id)
+    allocator.rebalance()
+    counts = sorted(len(images) for images in allocator.membership.values())
+    assert counts == [2, 2, 2]
+    adds, removes = allocator.changes()
+    assert not removes
+    assert sorted(img_id for album_id, img_id in adds) == ["4", "5", "6"]
+    # The original membership is left alone
+    assert membership["c"] == set()
+
+
+def test_sub_album_allocator_rebalances_removals():
+    membership = {"a": {"1", "2", "3", "4"}, "b": {"5", "6", "7"}, "c": {"8", "9", "10"}}
+    allocator = entities.SubAlbumAllocator(membership)
+    allocator.remove("5")
+    allocator.remove("6")
+    allocator.remove("no-such-image")
+    allocator.rebalance()
+    counts = sorted(len(images) for images in allocator.membership.values())
+    assert counts == [2, 3, 3]
+    adds, removes = allocator.changes()
+    # One image moved from 'a' to 'b'
+    assert [album_id for album_id, img_id in adds] == ["b"]
+    assert sorted(album_id for album_id, img_id in removes) == ["a", "b", "b"]
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_update_frame_album_sends_delta(album_with_20_images, frame_obj, image_factory):
+    album_obj = entities.Album.get(album_with_20_images)
+    frame_obj.set_album(album_obj)
+    new_image = image_factory("delta_image")
+    removed_image = album_obj.images[0]
+    selected = [img_id for img_id in album_obj.image_ids if img_id != removed_image.pkid]
+    with patch("utils.write_keys") as mock_write_keys:
+        album_obj.update_images(selected + [new_image])
+    mock_write_keys.assert_called_once()
+    frame_ids, topic, delta = mock_write_keys.call_args[0]
+    assert frame_ids == [frame_obj.pkid]
+    assert topic == "images_delta"
+    # Adding the 20 images was version 1
+    assert delta == {"version": 2, "add": ["delta_image"], "remove": [removed_image.name]}
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_update_frame_album_sends_snapshot(album_with_20_images, frame_obj):
+    album_obj = entities.Album.get(album_with_20_images)
+    frame_obj.set_album(album_obj)
+    with patch("utils.write_topics") as mock_write_topics:
+        album_obj.update_frame_album()
+    mock_write_topics.assert_called_once()
+    frame_ids, values = mock_write_topics.call_args[0]
+    assert frame_ids == [frame_obj.pkid]
+    assert sorted(values) == ["images", "images_version"]
+    assert values["images_version"] == 1
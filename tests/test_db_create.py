@@ -0,0 +1,32 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import db_create
+
+
+def test_upgrade_existing_db(test_db_cursor):
+    # An image table, and an album table, from before these columns were added
+    test_db_cursor.execute("alter table image drop index image_content_hash;")
+    test_db_cursor.execute("alter table image drop column content_hash;")
+    test_db_cursor.execute("alter table album drop column rules, drop column images_version;")
+    test_db_cursor.execute("drop table keyword_vocab;")
+    db_create.upgrade(test_db_cursor)
+    assert "content_hash" in db_create._columns(test_db_cursor, "image")
+    assert "image_content_hash" in db_create._index_names(test_db_cursor, "image", unique=True)
+    assert {"rules", "images_version"}.issubset(db_create._columns(test_db_cursor, "album"))
+    test_db_cursor.execute("select count(*) as num from keyword_vocab;")
+    assert test_db_cursor.fetchone()["num"] == 0
+    # Nothing changes when it's run again
+    db_create.upgrade(test_db_cursor)
+
+
+def test_upgrade_makes_content_hash_unique(test_db_cursor, image_factory):
+    # An image table from when the same contents could be imported twice
+    test_db_cursor.execute("alter table image drop index image_content_hash;")
+    test_db_cursor.execute("create index image_content_hash on image (content_hash);")
+    image_factory("first.jpg")
+    image_factory("second.jpg")
+    test_db_cursor.execute("update image set content_hash = %s;", ("a" * 64,))
+    db_create.upgrade(test_db_cursor)
+    assert "image_content_hash" in db_create._index_names(test_db_cursor, "image", unique=True)
+    test_db_cursor.execute("select count(*) as num from image where content_hash is not null;")
+    assert test_db_cursor.fetchone()["num"] == 1
@@ -1,8 +1,14 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+from datetime import timedelta
+from decimal import Decimal
+
+from mock import MagicMock, patch
 import pytest
 
 import entities
+import frames
+import photoserver
 
 
 @pytest.mark.usefixtures("mock_etcd")
@@ -35,3 +41,189 @@ def test_after_get_with_frameset(frameset_with_6_frames, test_db_cursor):
     frameset_name = frameset_obj.name
     for frame_obj in frameset_obj.child_frames:
         assert frame_obj.frameset_name == frameset_name
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_frame_status_etag(frame_obj, album_obj, test_db_cursor):
+    frame_obj.set_album(album_obj)
+    client = photoserver.app.test_client()
+    url = "/frames/{}/status".format(frame_obj.pkid)
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.get_json()["images"] == []
+    etag = resp.headers["ETag"]
+    resp = client.get(url, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    # Changing a setting changes the ETag
+    frame_obj.brightness = Decimal("0.5")
+    frame_obj.save()
+    resp = client.get(url, headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_frame_register_new(test_db_cursor):
+    frame, images_version = entities.Frame.register("new-frame", "10.0.0.5", 1234)
+    assert frame.pkid == "new-frame"
+    assert frame.name == entities.Frame.name
+    assert images_version is None
+    test_db_cursor.execute("select * from frame where pkid = %s;", ("new-frame",))
+    rec = test_db_cursor.fetchone()
+    assert rec["ip"] == "10.0.0.5"
+    assert rec["freespace"] == 1234
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_frame_register_existing(frame_obj, album_obj, test_db_cursor):
+    frame_obj.description = "Keep me"
+    frame_obj.save()
+    frame_obj.set_album(album_obj)
+    frame, images_version = entities.Frame.register(frame_obj.pkid, "10.0.0.6", 99)
+    assert frame.description == "Keep me"
+    assert frame.album_id == album_obj.pkid
+    assert frame.ip == "10.0.0.6"
+    assert frame.freespace == 99
+    assert images_version == album_obj.images_version
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_image_names_for_version(album_obj, image_obj, test_db_cursor):
+    names = entities.Album.image_names_for_version(album_obj.pkid, 0)
+    assert names == []
+    album_obj.add_image(image_obj)
+    # The cached names are used until the version changes
+    assert entities.Album.image_names_for_version(album_obj.pkid, 0) == []
+    album_obj = entities.Album.get(album_obj.pkid)
+    names = entities.Album.image_names_for_version(album_obj.pkid, album_obj.images_version)
+    assert names == [image_obj.name]
+
+
+def test_image_names_for_missing_album():
+    entities._album_image_names.pop("missing", None)
+    # A frame whose album has been deleted gets the album's version as None
+    assert entities.Album.image_names_for_version("missing", None) == []
+    assert "missing" not in entities._album_image_names
+
+
+def test_heartbeat_buffer_flush(frame_obj, test_db_cursor):
+    buffer = frames.HeartbeatBuffer(size=3)
+    buffer.record(frame_obj.pkid, "10.0.0.7", freespace=100, uptime=5)
+    buffer.record(frame_obj.pkid, "10.0.0.7", freespace=90, uptime=10)
+    buffer.record("other", "10.0.0.8", temperature=Decimal("45.5"))
+    # The latest values come from the buffer
+    assert buffer.latest(frame_obj.pkid)["freespace"] == 90
+    assert len(buffer.recent(frame_obj.pkid)) == 2
+    # Only the latest heartbeat for each frame is written
+    assert buffer.flush() == 2
+    test_db_cursor.execute("select * from frame_heartbeat order by frame_id;")
+    recs = test_db_cursor.fetchall()
+    assert len(recs) == 2
+    assert {rec["frame_id"]: rec["uptime"] for rec in recs}[frame_obj.pkid] == 10
+    assert entities.Frame.get(frame_obj.pkid).freespace == 90
+    # Nothing new to write
+    assert buffer.flush() == 0
+
+
+def test_heartbeat_stale_flush(frame_obj, test_db_cursor):
+    # Two workers, each with its own buffer; the second one's heartbeat is older
+    newer = frames.HeartbeatBuffer()
+    older = frames.HeartbeatBuffer()
+    older.record(frame_obj.pkid, "10.0.0.7", freespace=50)
+    older._latest[frame_obj.pkid]["received"] -= timedelta(seconds=30)
+    newer.record(frame_obj.pkid, "10.0.0.8", freespace=80)
+    newer.flush()
+    older.flush()
+    test_db_cursor.execute("select * from frame_heartbeat where frame_id = %s;", (frame_obj.pkid,))
+    rec = test_db_cursor.fetchone()
+    assert (rec["ip"], rec["freespace"]) == ("10.0.0.8", 80)
+    frame = entities.Frame.get(frame_obj.pkid)
+    assert (frame.ip, frame.freespace) == ("10.0.0.8", 80)
+    # The older worker sees the newer heartbeat from the DB
+    assert older.latest(frame_obj.pkid)["freespace"] == 80
+
+
+def test_heartbeat_ring_buffer_size():
+    buffer = frames.HeartbeatBuffer(size=2)
+    for uptime in range(5):
+        buffer.record("frame", "10.0.0.9", uptime=uptime)
+    assert [hb["uptime"] for hb in buffer.recent("frame")] == [3, 4]
+
+
+def test_frame_state_cache(mock_etcd):
+    cache = frames.FrameStateCache()
+    # Don't start the watch thread
+    cache.start = MagicMock()
+    clt = mock_etcd.return_value
+    clt.get_prefix.return_value = [
+        (b"", MagicMock(key=b"/frame1:state", mod_revision=4)),
+        (b"", MagicMock(key=b"/frame1:current_display", mod_revision=6)),
+        (b"", MagicMock(key=b"/frame1:images", mod_revision=5)),
+    ]
+    clt.transaction.return_value = (True, [[(b'"sleeping"', None)], [(b'"req1"', None)]])
+    assert cache.load() == 7
+    # Only the keys are listed, and the image list isn't read
+    assert clt.get_prefix.call_args[1] == {"keys_only": True}
+    clt.transactions.get.assert_any_call("/frame1:state")
+    assert clt.transactions.get.call_count == 2
+    state = cache.get("frame1")
+    assert state["state"] == "sleeping"
+    assert state["pending"] == {"current_display": "req1"}
+    # The frame's answer clears the request, and records the image it is showing
+    cache.apply("/req1:", b'"b.jpg"')
+    cache.apply("/frame1:reboot", b'{"command_id": "cmd1", "value": "now"}')
+    state = cache.get("frame1")
+    assert state["current_image"] == "b.jpg"
+    assert list(state["pending"]) == ["reboot"]
+    cache.apply("/cmd1:ack/frame1", b'"OK"')
+    assert cache.get("frame1")["pending"] == {}
+    assert cache.get("unknown") == {"state": None, "current_image": None, "pending": {}}
+
+
+def test_frame_state_cache_broadcast(mock_etcd):
+    cache = frames.FrameStateCache()
+    cache.start = MagicMock()
+    frame_ids = ["frame1", "frame2", "frame3"]
+    # A broadcast command has the same command_id for every frame
+    for frame_id in frame_ids:
+        cache.apply("/{}:reboot".format(frame_id), b'{"command_id": "cmd1", "value": "now"}')
+    # The acks can arrive in any order
+    cache.apply("/cmd1:ack/frame2", b'"OK"')
+    assert cache.get("frame2")["pending"] == {}
+    assert list(cache.get("frame1")["pending"]) == ["reboot"]
+    assert list(cache.get("frame3")["pending"]) == ["reboot"]
+    cache.apply("/cmd1:ack/frame1", b'"OK"')
+    cache.apply("/cmd1:ack/frame3", b'"OK"')
+    assert all(cache.get(frame_id)["pending"] == {} for frame_id in frame_ids)
+
+
+def test_frame_state_cache_attaches_ack_leases(mock_etcd):
+    cache = frames.FrameStateCache()
+    cache.start = MagicMock()
+    clt = mock_etcd.return_value
+    events = [
+        MagicMock(key=b"/cmd1:command", value=b'{"topic": "reboot", "lease": 7}'),
+        MagicMock(key=b"/cmd1:ack/frame1", value=b'"OK"', lease=7),
+        MagicMock(key=b"/cmd1:ack/frame2", value=b'"OK"', lease=0, mod_revision=12),
+        MagicMock(key=b"/req1:", value=b'"a.jpg"', lease=0),
+    ]
+    clt.watch_prefix.return_value = (iter(events), MagicMock())
+    with patch("utils.etcd3.events.DeleteEvent", type(None)):
+        cache.watch()
+    # Only the ack that the frame didn't attach to the command's lease is written again,
+    # and only if no other worker has already done it
+    clt.transaction.assert_called_once()
+    clt.transactions.put.assert_called_once_with("/cmd1:ack/frame2", b'"OK"', lease=7)
+    clt.transactions.mod.assert_called_once_with("/cmd1:ack/frame2")
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_frame_get_many(frameset_with_6_frames, frame_factory, test_db_cursor):
+    frameset_name = entities.Frameset.get(frameset_with_6_frames).name
+    loose_id = frame_factory("Loose")
+    child_ids = entities.Frameset(pkid=frameset_with_6_frames).child_frame_ids
+    frame_objs = entities.Frame.get_many([loose_id] + child_ids)
+    assert [frm.pkid for frm in frame_objs] == [loose_id] + child_ids
+    assert frame_objs[0].frameset_name == ""
+    assert all(frm.frameset_name == frameset_name for frm in frame_objs[1:])
+    assert entities.Frame.get_many([]) == []
@@ -1,8 +1,12 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+import json
+
 import pytest
+from werkzeug.exceptions import NotFound
 
 import entities
+import framesets
 
 
 @pytest.fixture
@@ -74,3 +78,36 @@ def test_new_frameset(test_db_cursor):
     assert not fs.pkid
     fs.save()
     assert fs.pkid
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_frameset_num_frames(frameset_with_6_frames, frameset_factory):
+    empty = frameset_factory("empty")
+    assert entities.Frameset.get(frameset_with_6_frames).num_frames == 6
+    assert entities.Frameset.get(empty).num_frames == 0
+    counts = {fs.pkid: fs.num_frames for fs in entities.Frameset.list()}
+    assert counts == {frameset_with_6_frames: 6, empty: 0}
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_frameset_get_many(frameset_with_6_frames, frameset_factory):
+    other = frameset_factory("other")
+    fs_objs = entities.Frameset.get_many([other, "missing", frameset_with_6_frames])
+    assert [fs.pkid for fs in fs_objs] == [other, frameset_with_6_frames]
+    assert [fs.num_frames for fs in fs_objs] == [0, 6]
+
+
+def test_command_status_checks_frameset(
+    frameset_with_6_frames, frameset_factory, mock_etcd, test_db_cursor
+):
+    frame_ids = entities.Frameset(pkid=frameset_with_6_frames).child_frame_ids
+    command = {"topic": "reboot", "value": "now", "frames": frame_ids, "lease": 7}
+    clt = mock_etcd.return_value
+    clt.get.return_value = (json.dumps(command), None)
+    clt.get_prefix.return_value = []
+    status = json.loads(framesets.command_status(frameset_with_6_frames, "cmd1"))
+    assert status["pending"] == frame_ids
+    # The command wasn't sent to another frameset's frames
+    other_id = frameset_factory("other")
+    with pytest.raises(NotFound):
+        framesets.command_status(other_id, "cmd1")
@@ -1,8 +1,19 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+import base64
+from datetime import datetime
+import hashlib
+import io
+import json
+import os
+
+from mock import patch
+from PIL import Image as PIL_Image
 import pytest
 
 import entities
+import images
+import utils
 
 
 def test_image_create(test_db_cursor, image):
@@ -25,3 +36,145 @@ def test_image_update(test_db_cursor, image, name, height, width):
     assert new_image_obj.name == name
     assert new_image_obj.height == height
     assert new_image_obj.width == width
+
+
+def test_image_list_page(test_db_cursor, image_factory):
+    names = ["img{:02}".format(num) for num in range(7)]
+    for name in names:
+        image_factory(name)
+    assert entities.Image.count() == 7
+    page = entities.Image.list_page(page_size=3)
+    assert [img.name for img in page.items] == names[:3]
+    assert page.prev_token is None
+    page = entities.Image.list_page(page_size=3, page_token=page.next_token)
+    assert [img.name for img in page.items] == names[3:6]
+    last_page = entities.Image.list_page(page_size=3, page_token=page.next_token)
+    assert [img.name for img in last_page.items] == names[6:]
+    assert last_page.next_token is None
+    # Go back from the last page
+    page = entities.Image.list_page(page_size=3, page_token=last_page.prev_token)
+    assert [img.name for img in page.items] == names[3:6]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"k": 5, "b": False},
+        {"k": ["img01"]},
+        {"k": ["img01"], "b": "yes"},
+        {"k": [{}], "b": False},
+        [1],
+    ],
+)
+def test_malformed_page_token(payload):
+    token = base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+    assert entities._decode_page_token(token) == (None, False)
+    assert entities._decode_page_token("not a token!") == (None, False)
+    good = entities._encode_page_token(["img01", "1"], backwards=True)
+    assert entities._decode_page_token(good) == (["img01", "1"], True)
+
+
+def test_image_count_filtered(test_db_cursor, image_factory):
+    image_factory("horiz", orientation="H")
+    image_factory("vert1", orientation="V")
+    image_factory("vert2", orientation="V")
+    assert entities.Image.count(orientation="V") == 2
+    assert len(entities.Image.list(orientation="V")) == 2
+
+
+def test_image_keyword_filter(test_db_cursor, image_factory):
+    dog_cat = image_factory("dog_cat", keywords="Dog cat")
+    dog = image_factory("dog", keywords="dog")
+    image_factory("bird", keywords="bird")
+    assert {img.pkid for img in entities.Image.list(keywords="dog")} == {dog_cat, dog}
+    assert [img.pkid for img in entities.Image.list(keywords="cat DOG")] == [dog_cat]
+    assert entities.Image.count(keywords="fish") == 0
+
+
+def test_image_keyword_index_updated(test_db_cursor, image):
+    image_obj = entities.Image.get(image)
+    image_obj.keywords = "beach sunset"
+    image_obj.save()
+    assert [img.pkid for img in entities.Image.list(keywords="sunset")] == [image]
+    image_obj.keywords = "beach"
+    image_obj.save()
+    assert entities.Image.count(keywords="sunset") == 0
+
+
+def test_keyword_vocab_counts(test_db_cursor, image_factory):
+    first = image_factory("first", keywords="beach sunset")
+    image_factory("second", keywords="beach")
+    assert utils.keyword_counts() == {"beach": 2, "sunset": 1}
+    first_obj = entities.Image.get(first)
+    first_obj.keywords = "mountain"
+    first_obj.save()
+    assert utils.keyword_counts() == {"beach": 1, "mountain": 1}
+    entities.Image.delete(first)
+    assert utils.all_keywords() == ["beach"]
+
+
+def test_image_info(tmp_path):
+    fpath = str(tmp_path / "photo.jpg")
+    exif = PIL_Image.Exif()
+    exif.get_ifd(images.EXIF_IFD_KEY)[images.CREATE_DATE_KEY] = "2020:05:01 10:20:30"
+    PIL_Image.new("RGB", (40, 30)).save(fpath, format="JPEG", exif=exif)
+    info = images.image_info(fpath)
+    assert (info["imgtype"], info["width"], info["height"]) == ("JPEG", 40, 30)
+    assert info["orientation"] == "H"
+    assert info["created"] == "2020:05:01 10:20:30"
+    # PNGs have no EXIF creation date, so the file's modification time is used
+    fpath = str(tmp_path / "photo.png")
+    PIL_Image.new("RGB", (30, 40)).save(fpath, format="PNG")
+    os.utime(fpath, (1600000000, 1600000000))
+    info = images.image_info(fpath)
+    assert (info["imgtype"], info["orientation"]) == ("PNG", "V")
+    assert info["created"] == datetime.fromtimestamp(1600000000)
+
+
+def test_save_upload(tmp_path):
+    data = b"x" * (images.UPLOAD_CHUNK_SIZE + 10)
+    upload_path, content_hash, size = images.save_upload(io.BytesIO(data), folder=str(tmp_path))
+    assert size == len(data)
+    assert content_hash == hashlib.sha256(data).hexdigest()
+    with open(upload_path, "rb") as ff:
+        assert ff.read() == data
+
+
+def test_import_folder_path(tmp_path):
+    root = tmp_path / "import"
+    (root / "batch1").mkdir(parents=True)
+    (tmp_path / "private").mkdir()
+    (root / "escape").symlink_to(tmp_path / "private")
+    with patch("images.IMPORT_FOLDER", str(root)):
+        assert images.import_folder_path("batch1") == str(root / "batch1")
+        assert images.import_folder_path("../private") is None
+        assert images.import_folder_path(str(tmp_path / "private")) is None
+        # A link out of the import folder isn't followed
+        assert images.import_folder_path("escape") is None
+        assert images.import_folder_path("missing") is None
+
+
+def test_file_hash(tmp_path):
+    data = b"x" * (images.UPLOAD_CHUNK_SIZE + 10)
+    fpath = tmp_path / "data"
+    fpath.write_bytes(data)
+    assert images.file_hash(str(fpath)) == hashlib.sha256(data).hexdigest()
+
+
+def test_find_by_hash(test_db_cursor, image_factory):
+    content_hash = hashlib.sha256(b"image").hexdigest()
+    pkid = image_factory("original", content_hash=content_hash)
+    image_factory("unhashed")
+    rec = images.find_by_hash(content_hash.upper())
+    assert (rec["pkid"], rec["name"]) == (pkid, "original")
+    assert images.find_by_hash(hashlib.sha256(b"other").hexdigest()) is None
+
+
+@pytest.mark.usefixtures("mock_etcd")
+def test_update_img_db_skips_uploads(test_db_cursor, tmp_path):
+    PIL_Image.new("RGB", (40, 30)).save(str(tmp_path / "photo.jpg"), format="JPEG")
+    # An upload that is still being written
+    PIL_Image.new("RGB", (30, 40)).save(str(tmp_path / ".upload-abc"), format="JPEG")
+    utils.update_img_db(img_dir=str(tmp_path), cursor=test_db_cursor)
+    test_db_cursor.execute("select name from image;")
+    assert [rec["name"] for rec in test_db_cursor.fetchall()] == ["photo.jpg"]
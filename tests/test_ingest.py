@@ -0,0 +1,138 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+
+from mock import patch
+from PIL import Image
+import pytest
+
+import ingest
+
+
+@pytest.fixture
+def import_folder(tmp_path):
+    folder = tmp_path / "import"
+    folder.mkdir()
+    for num in range(3):
+        img = Image.new("RGB", (64, 48), (num * 80, 0, 0))
+        img.save(str(folder / "img{}.jpg".format(num)), format="JPEG")
+    return str(folder)
+
+
+@pytest.fixture
+def image_folder(tmp_path):
+    folder = tmp_path / "images"
+    folder.mkdir()
+    with patch("images.IMAGE_FOLDER", str(folder)):
+        yield str(folder)
+
+
+def job_statuses(crs):
+    crs.execute("select stage, status from ingest_job;")
+    return [(rec["stage"], rec["status"]) for rec in crs.fetchall()]
+
+
+def test_enqueue_is_idempotent(test_db_cursor, import_folder):
+    batch_id, added = ingest.enqueue_folder(import_folder)
+    assert added == 3
+    other_batch, added = ingest.enqueue_folder(import_folder)
+    assert added == 0
+    assert ingest.progress(batch_id)["total"] == 3
+    assert job_statuses(test_db_cursor) == [("register", "pending")] * 3
+
+
+def test_work_runs_all_stages(test_db_cursor, import_folder, image_folder):
+    batch_id, added = ingest.enqueue_folder(import_folder, keywords="holiday")
+    assert ingest.work(worker_id="test") == 6
+    summary = ingest.progress(batch_id)
+    assert (summary["done"], summary["failed"], summary["complete"]) == (3, 0, True)
+    test_db_cursor.execute("select name, keywords from image order by name;")
+    recs = test_db_cursor.fetchall()
+    assert [rec["name"] for rec in recs] == ["img0.jpg", "img1.jpg", "img2.jpg"]
+    assert recs[0]["keywords"] == "holiday"
+    assert not os.listdir(import_folder)
+    assert os.path.exists(os.path.join(image_folder, "thumbs", "img0.jpg"))
+
+
+def test_stage_concurrency_limit(test_db_cursor, import_folder):
+    ingest.enqueue_folder(import_folder)
+    with patch.dict(ingest.STAGE_CONCURRENCY, {"register": 1}):
+        assert ingest.claim_job("one") is not None
+        # The only register slot is taken
+        assert ingest.claim_job("two") is None
+
+
+def test_failed_stage_is_retried(test_db_cursor, import_folder, image_folder):
+    ingest.enqueue_folder(import_folder)
+    job = ingest.claim_job("test")
+    with patch.dict(ingest.STAGE_HANDLERS, {"register": lambda job: 1 / 0}):
+        assert ingest.run_job(job) is False
+    test_db_cursor.execute("select * from ingest_job where pkid = %s;", (job["pkid"],))
+    rec = test_db_cursor.fetchone()
+    assert (rec["status"], rec["attempts"]) == ("pending", 1)
+    assert "division by zero" in rec["last_error"]
+    # Once the attempts are used up, the job fails
+    job["attempts"] = ingest.MAX_ATTEMPTS
+    with patch.dict(ingest.STAGE_HANDLERS, {"register": lambda job: 1 / 0}):
+        ingest.run_job(job)
+    test_db_cursor.execute("select status from ingest_job where pkid = %s;", (job["pkid"],))
+    assert test_db_cursor.fetchone()["status"] == "failed"
+
+
+def test_invalid_image_fails_without_retry(test_db_cursor, tmp_path, image_folder):
+    folder = tmp_path / "bad"
+    folder.mkdir()
+    (folder / "notes.txt").write_text("Not an image")
+    batch_id, added = ingest.enqueue_folder(str(folder))
+    ingest.run_job(ingest.claim_job("test"))
+    summary = ingest.progress(batch_id)
+    assert summary["failed"] == 1
+    assert "not a valid image" in summary["failures"][0]["last_error"]
+
+
+def test_duplicate_contents_are_linked(test_db_cursor, import_folder, image_folder, tmp_path):
+    batch_id, added = ingest.enqueue_folder(import_folder)
+    ingest.work(worker_id="test")
+    folder = tmp_path / "again"
+    folder.mkdir()
+    # The same image as img0.jpg, under another name
+    Image.new("RGB", (64, 48), (0, 0, 0)).save(str(folder / "copy.jpg"), format="JPEG")
+    batch_id, added = ingest.enqueue_folder(str(folder))
+    assert ingest.work(worker_id="test") == 1
+    assert ingest.progress(batch_id)["done"] == 1
+    test_db_cursor.execute("select image_id from ingest_job where batch_id = %s;", (batch_id,))
+    image_id = test_db_cursor.fetchone()["image_id"]
+    test_db_cursor.execute("select name from image where pkid = %s;", (image_id,))
+    assert test_db_cursor.fetchone()["name"] == "img0.jpg"
+    test_db_cursor.execute("select count(*) as num from image;")
+    assert test_db_cursor.fetchone()["num"] == 3
+
+
+def test_retry_after_linking_duplicate(test_db_cursor, import_folder, image_folder, tmp_path):
+    ingest.enqueue_folder(import_folder)
+    ingest.work(worker_id="test")
+    folder = tmp_path / "again"
+    folder.mkdir()
+    Image.new("RGB", (64, 48), (0, 0, 0)).save(str(folder / "copy.jpg"), format="JPEG")
+    batch_id, added = ingest.enqueue_folder(str(folder))
+    job = ingest.claim_job("test")
+    assert ingest._register(job) is True
+    # The job was linked, but the worker died before finishing it
+    test_db_cursor.execute("select * from ingest_job where pkid = %s;", (job["pkid"],))
+    rec = test_db_cursor.fetchone()
+    assert rec["duplicate"] == 1
+    assert ingest._register(rec) is True
+
+
+def test_concurrent_duplicate_is_linked(test_db_cursor, import_folder, image_folder, tmp_path):
+    ingest.enqueue_folder(import_folder)
+    ingest.work(worker_id="test")
+    folder = tmp_path / "again"
+    folder.mkdir()
+    Image.new("RGB", (64, 48), (0, 0, 0)).save(str(folder / "copy.jpg"), format="JPEG")
+    batch_id, added = ingest.enqueue_folder(str(folder))
+    # The other worker's image isn't visible yet when this one checks for it
+    with patch("ingest._link_duplicate", side_effect=[False, True]):
+        assert ingest.run_job(ingest.claim_job("test")) is True
+    assert os.path.exists(str(folder / "copy.jpg"))
+    assert not os.path.exists(os.path.join(image_folder, "copy.jpg"))
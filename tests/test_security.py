@@ -0,0 +1,51 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import datetime as dt
+
+from mock import MagicMock, patch
+import pytest
+
+import security
+
+
+@pytest.fixture
+def login_crs():
+    """Patches DbCursor with a cursor whose login record expires in an hour."""
+    crs = MagicMock()
+    crs.fetchone.return_value = {"expires": dt.datetime.utcnow() + dt.timedelta(hours=1)}
+    with patch("utils.DbCursor") as mock_cursor:
+        mock_cursor.return_value.__enter__.return_value = crs
+        security._token_cache.clear()
+        # Don't purge the login table unless a test asks for it
+        security._last_purge = dt.datetime.utcnow()
+        yield crs
+    security._token_cache.clear()
+
+
+def test_token_is_cached(login_crs):
+    assert security._token_is_valid("abc")
+    assert security._token_is_valid("abc")
+    assert login_crs.execute.call_count == 1
+
+
+def test_expired_token(login_crs):
+    login_crs.fetchone.return_value = {"expires": dt.datetime.utcnow() - dt.timedelta(hours=1)}
+    assert not security._token_is_valid("abc")
+    assert "abc" not in security._token_cache
+
+
+def test_cache_bounded_by_expiration(login_crs):
+    expires = dt.datetime.utcnow() + dt.timedelta(seconds=5)
+    login_crs.fetchone.return_value = {"expires": expires}
+    assert security._token_is_valid("abc")
+    assert security._token_cache["abc"] == expires
+
+
+def test_expired_logins_purged_periodically(login_crs):
+    security._last_purge = dt.datetime.utcnow() - security.PURGE_INTERVAL
+    assert security._token_is_valid("abc")
+    assert security._token_is_valid("def")
+    sqls = [call[0][0] for call in login_crs.execute.call_args_list]
+    # Only the first check purges; the second is within the interval
+    assert sum(sql.startswith("DELETE FROM login") for sql in sqls) == 1
+    assert len(sqls) == 3
@@ -0,0 +1,142 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+
+from mock import patch
+from PIL import Image
+
+import thumbnails
+
+
+def make_jpeg(folder, name, size=(800, 600)):
+    fpath = os.path.join(folder, name)
+    Image.new("RGB", size, "red").save(fpath, format="JPEG")
+    return fpath
+
+
+def test_build_thumbnails(tmp_path):
+    img_dir = str(tmp_path)
+    for num in range(3):
+        make_jpeg(img_dir, "img{}.jpg".format(num))
+    with open(os.path.join(img_dir, "notes.txt"), "w") as ff:
+        ff.write("Not an image")
+    messages = []
+    stats = thumbnails.build_thumbnails(img_dir, workers=2, report=messages.append)
+    assert (stats["built"], stats["failed"], stats["skipped"]) == (3, 1, 0)
+    tpath = os.path.join(img_dir, "thumbs", "img0.jpg")
+    with Image.open(tpath) as thumb:
+        assert thumb.format == "JPEG"
+        assert max(thumb.size) <= max(thumbnails.THUMB_SIZE)
+    assert messages
+    # Nothing is left over from the temporary files
+    assert sorted(os.listdir(os.path.join(img_dir, "thumbs"))) == [
+        "img0.jpg",
+        "img1.jpg",
+        "img2.jpg",
+    ]
+
+
+def test_build_thumbnails_skips_current(tmp_path):
+    img_dir = str(tmp_path)
+    fpath = make_jpeg(img_dir, "old.jpg")
+    make_jpeg(img_dir, "new.jpg")
+    thumbnails.build_thumbnails(img_dir, workers=1, report=lambda msg: None)
+    stats = thumbnails.build_thumbnails(img_dir, workers=1, report=lambda msg: None)
+    assert (stats["built"], stats["skipped"]) == (0, 2)
+    # An original that is newer than its thumbnail is rebuilt
+    tpath = os.path.join(img_dir, "thumbs", "old.jpg")
+    mtime = os.stat(tpath).st_mtime
+    os.utime(fpath, (mtime + 10, mtime + 10))
+    stats = thumbnails.build_thumbnails(img_dir, workers=1, report=lambda msg: None)
+    assert (stats["built"], stats["skipped"]) == (1, 1)
+    stats = thumbnails.build_thumbnails(img_dir, workers=1, force=True, report=lambda msg: None)
+    assert stats["built"] == 2
+
+
+def test_build_renditions(tmp_path):
+    img_dir = str(tmp_path)
+    make_jpeg(img_dir, "wide.jpg", size=(4000, 3000))
+    make_jpeg(img_dir, "small.jpg", size=(300, 200))
+    stats = thumbnails.build_renditions(img_dir, workers=1, report=lambda msg: None)
+    assert stats["built"] == 2
+    for rendition, box in thumbnails.RENDITIONS.items():
+        with Image.open(os.path.join(img_dir, rendition, "wide.jpg")) as rendered:
+            assert rendered.width <= box[0] and rendered.height <= box[1]
+            # It fills the box in one direction
+            assert box[0] - rendered.width <= 1 or box[1] - rendered.height <= 1
+        # Small images are never enlarged
+        with Image.open(os.path.join(img_dir, rendition, "small.jpg")) as rendered:
+            assert rendered.width <= 300
+    thumbnails.remove_renditions("small.jpg", img_dir)
+    assert not os.path.exists(os.path.join(img_dir, "preview", "small.jpg"))
+    stats = thumbnails.build_renditions(img_dir, workers=1, report=lambda msg: None)
+    assert (stats["built"], stats["skipped"]) == (1, 1)
+
+
+def test_pick_rendition():
+    # A horizontal 4000x3000 original
+    assert thumbnails.pick_rendition(4000, 3000, 120, 120) == "thumbs"
+    assert thumbnails.pick_rendition(4000, 3000, 1280, 800) == "1280x800"
+    # The 800x1280 rendition is only 800 wide, so a larger one is needed
+    assert thumbnails.pick_rendition(4000, 3000, 1024, 1024) == "1280x800"
+    assert thumbnails.pick_rendition(4000, 3000, 1920, 1080) == "1920x1080"
+    assert thumbnails.pick_rendition(4000, 3000, 3000, 3000) is None
+    # Nothing is smaller than an original that is already small enough
+    assert thumbnails.pick_rendition(1000, 700, 1280, 800) is None
+
+
+def test_resized_image(tmp_path):
+    img_dir = str(tmp_path)
+    make_jpeg(img_dir, "photo.jpg", size=(1600, 1200))
+    path = thumbnails.resized_image("photo.jpg", 400, 400, img_dir=img_dir)
+    with Image.open(path) as resized:
+        assert resized.size == (400, 300)
+    path = thumbnails.resized_image("photo.jpg", 400, 400, fit="cover", img_dir=img_dir)
+    with Image.open(path) as resized:
+        assert resized.size == (400, 400)
+    path = thumbnails.resized_image("photo.jpg", None, 600, img_dir=img_dir)
+    with Image.open(path) as resized:
+        assert resized.size == (800, 600)
+
+
+def test_resized_image_cached(tmp_path):
+    img_dir = str(tmp_path)
+    make_jpeg(img_dir, "photo.jpg")
+    with patch("thumbnails._resize", wraps=thumbnails._resize) as mock_resize:
+        first = thumbnails.resized_image("photo.jpg", 200, 200, quality=50, img_dir=img_dir)
+        second = thumbnails.resized_image("photo.jpg", 200, 200, quality=50, img_dir=img_dir)
+        assert first == second
+        assert mock_resize.call_count == 1
+        # A different variant is a different entry
+        third = thumbnails.resized_image("photo.jpg", 200, 200, img_dir=img_dir)
+        assert third != first
+        assert mock_resize.call_count == 2
+
+
+def test_trim_resize_cache(tmp_path):
+    img_dir = str(tmp_path)
+    cache_dir = thumbnails.resize_cache_folder(img_dir)
+    os.makedirs(cache_dir)
+    for num in range(5):
+        path = os.path.join(cache_dir, "{}.jpg".format(num))
+        with open(path, "wb") as ff:
+            ff.write(b"x" * 100)
+        os.utime(path, (1000 + num, 1000 + num))
+    assert thumbnails.trim_resize_cache(max_bytes=1000, img_dir=img_dir) == 0
+    # The least recently used are removed first
+    assert thumbnails.trim_resize_cache(max_bytes=300, img_dir=img_dir) == 3
+    assert sorted(os.listdir(cache_dir)) == ["3.jpg", "4.jpg"]
+
+
+def test_trim_resize_cache_skips_files_being_written(tmp_path):
+    img_dir = str(tmp_path)
+    cache_dir = thumbnails.resize_cache_folder(img_dir)
+    os.makedirs(cache_dir)
+    for name in ("old.jpg", "stale.jpg.12.tmp", "new.jpg.34.tmp"):
+        with open(os.path.join(cache_dir, name), "wb") as ff:
+            ff.write(b"x" * 100)
+    os.utime(os.path.join(cache_dir, "old.jpg"), (1000, 1000))
+    # Left behind by a build that was stopped long ago
+    os.utime(os.path.join(cache_dir, "stale.jpg.12.tmp"), (2000, 2000))
+    assert thumbnails.trim_resize_cache(max_bytes=50, img_dir=img_dir) == 2
+    assert os.listdir(cache_dir) == ["new.jpg.34.tmp"]
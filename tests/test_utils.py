@@ -0,0 +1,233 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import time
+
+from flask import Flask, abort
+from mock import MagicMock, patch
+import pytest
+
+import utils
+
+
+class FakeConnection:
+    def __init__(self):
+        self.open = True
+        self.pings = 0
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def db_pool():
+    with patch("utils.connect", side_effect=FakeConnection):
+        yield utils.ConnectionPool(max_size=2, max_idle=60, check_after=10, timeout=0.1)
+
+
+def test_pool_reuses_connections(db_pool):
+    conn = db_pool.get()
+    db_pool.put(conn)
+    assert db_pool.get() is conn
+    stats = db_pool.stats()
+    assert stats["created"] == 1
+    assert stats["reused"] == 1
+    assert stats["in_use"] == 1
+
+
+def test_pool_is_bounded(db_pool):
+    db_pool.get()
+    db_pool.get()
+    with pytest.raises(utils.PoolTimeout):
+        db_pool.get()
+    assert db_pool.stats()["timeouts"] == 1
+
+
+def test_pool_idle_connections(db_pool):
+    stale = db_pool.get()
+    checked = db_pool.get()
+    db_pool.put(stale)
+    db_pool.put(checked)
+    now = time.time()
+    db_pool._idle = [(stale, now - 120), (checked, now - 20)]
+    # Idle for a while; pinged before being reused
+    assert db_pool.get() is checked
+    assert checked.pings == 1
+    # Idle too long; closed and replaced
+    conn = db_pool.get()
+    assert conn is not stale
+    assert not stale.open
+    assert db_pool.stats()["discarded"] == 1
+
+
+def test_pool_after_fork(db_pool):
+    conn = db_pool.get()
+    db_pool.put(conn)
+    db_pool.pid = -1
+    assert db_pool.get() is not conn
+    # The parent's connection must not be closed
+    assert conn.open
+
+
+@pytest.fixture
+def request_app():
+    app = Flask(__name__)
+    app.after_request(utils.commit_request)
+    app.teardown_request(utils.release_request)
+    conn = MagicMock()
+
+    @app.route("/ok")
+    def ok():
+        for num in range(3):
+            with utils.DbCursor() as crs:
+                crs.execute("select 1")
+        return "OK"
+
+    @app.route("/fail")
+    def fail():
+        with utils.DbCursor() as crs:
+            crs.execute("delete from image")
+        abort(500)
+
+    # The frame pushes made by the routes, and whether the transaction had been
+    # committed when each was made
+    app.pushed = []
+
+    def push(val):
+        app.pushed.append((val, conn.commit.called))
+
+    @app.route("/push")
+    def push_ok():
+        with utils.DbCursor() as crs:
+            crs.execute("update image set name = 'new'")
+        utils.after_commit(push, "new")
+        return "OK"
+
+    @app.route("/push_fail")
+    def push_fail():
+        utils.after_commit(push, "new")
+        abort(500)
+
+    with patch("utils.pool") as mock_pool:
+        mock_pool.get.return_value = conn
+        yield app.test_client(), mock_pool, conn
+
+
+def test_request_shares_one_transaction(request_app):
+    client, mock_pool, conn = request_app
+    assert client.get("/ok").status_code == 200
+    mock_pool.get.assert_called_once_with()
+    conn.commit.assert_called_once_with()
+    conn.rollback.assert_not_called()
+    mock_pool.put.assert_called_once_with(conn)
+
+
+def test_failed_request_rolls_back(request_app):
+    client, mock_pool, conn = request_app
+    assert client.get("/fail").status_code == 500
+    conn.commit.assert_not_called()
+    conn.rollback.assert_called_once_with()
+    mock_pool.put.assert_called_once_with(conn)
+
+
+def test_write_keys_one_transaction(mock_etcd):
+    clt = mock_etcd.return_value
+    clt.transaction.return_value = (True, [])
+    results = utils.write_keys(["a", "b", "c"], "images", ["img1.jpg", "img2.jpg"])
+    assert results == {"/a:images": True, "/b:images": True, "/c:images": True}
+    clt.transaction.assert_called_once()
+    assert clt.transactions.put.call_count == 3
+    clt.put.assert_not_called()
+
+
+def test_write_keys_chunked(mock_etcd):
+    clt = mock_etcd.return_value
+    # The second chunk fails
+    clt.transaction.side_effect = [(True, []), (False, [])]
+    with patch("utils.ETCD_MAX_TXN_OPS", 2), patch("utils.ETCD_MAX_PARALLEL", 1):
+        results = utils.write_keys(["a", "b", "c"], "images", [])
+    assert clt.transaction.call_count == 2
+    assert results == {"/a:images": True, "/b:images": True, "/c:images": False}
+
+
+def test_write_topics_keeps_uuid_together(mock_etcd):
+    clt = mock_etcd.return_value
+    clt.transaction.return_value = (True, [])
+    values = {"images": ["img1.jpg"], "images_version": 3}
+    # Three ops per transaction only has room for one uuid's pair of keys
+    with patch("utils.ETCD_MAX_TXN_OPS", 3), patch("utils.ETCD_MAX_PARALLEL", 1):
+        results = utils.write_topics(["a", "b"], values)
+    assert clt.transaction.call_count == 2
+    for call in clt.transaction.call_args_list:
+        assert len(call[1]["success"]) == 2
+    assert sorted(results) == ["/a:images", "/a:images_version", "/b:images", "/b:images_version"]
+    assert all(results.values())
+
+
+def test_read_key_already_written(mock_etcd):
+    clt = mock_etcd.return_value
+    clt.watch.return_value = (iter([]), MagicMock())
+    clt.get.return_value = (b'"photo.jpg"', None)
+    assert utils.read_key("abc") == "photo.jpg"
+    # The watch is always cancelled
+    clt.watch.return_value[1].assert_called()
+
+
+def test_read_key_waits_for_put(mock_etcd):
+    clt = mock_etcd.return_value
+    event = MagicMock(spec=utils.etcd3.events.PutEvent, value=b'"photo.jpg"')
+    clt.watch.return_value = (iter([event]), MagicMock())
+    clt.get.return_value = (None, None)
+    assert utils.read_key("abc") == "photo.jpg"
+
+
+def test_read_key_timeout(mock_etcd):
+    clt = mock_etcd.return_value
+    clt.watch.return_value = (iter([]), MagicMock())
+    clt.get.return_value = (None, None)
+    assert utils.read_key("abc", timeout=0.1) == "TIMEOUT"
+
+
+def test_broadcast_command(mock_etcd):
+    clt = mock_etcd.return_value
+    clt.transaction.return_value = (True, [])
+    clt.lease.return_value.id = 7
+    command_id, results = utils.broadcast_command(["a", "b"], "reboot", "now")
+    assert results == {"/a:reboot": True, "/b:reboot": True}
+    # The command is recorded under a lease, and sent to all the frames in one transaction
+    clt.lease.assert_called_once_with(utils.COMMAND_TTL)
+    key, payload = clt.put.call_args[0]
+    assert key == "/{}:command".format(command_id)
+    assert utils.json.loads(payload)["frames"] == ["a", "b"]
+    assert clt.put.call_args[1]["lease"] is clt.lease.return_value
+    clt.transaction.assert_called_once()
+    clt.transactions.put.assert_any_call(
+        "/a:reboot", utils.json.dumps({"command_id": command_id, "value": "now", "lease": 7})
+    )
+
+
+def test_command_acks(mock_etcd):
+    clt = mock_etcd.return_value
+    clt.get_prefix.return_value = [
+        (b'"done"', MagicMock(key=b"/cmd:ack/a", lease_id=7)),
+        (b'"OK"', MagicMock(key=b"/cmd:ack/b", lease_id=0)),
+    ]
+    assert utils.command_acks("cmd") == {"a": "done", "b": "OK"}
+    clt.get_prefix.assert_called_once_with("/cmd:ack/")
+    # Reading the status never writes
+    clt.put.assert_not_called()
+    clt.transaction.assert_not_called()
+
+
+def test_pushes_wait_for_commit(request_app):
+    client, mock_pool, conn = request_app
+    assert client.get("/push").status_code == 200
+    assert client.application.pushed == [("new", True)]
+
+
+def test_failed_request_drops_pushes(request_app):
+    client, mock_pool, conn = request_app
+    assert client.get("/push_fail").status_code == 500
+    assert client.application.pushed == []
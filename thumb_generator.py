@@ -1,24 +1,26 @@
-import os
-from PIL import Image
+import argparse
 
+import thumbnails
 
-IMAGE_FOLDER = "/var/www/photoserver/"
 
-for fname in os.listdir(IMAGE_FOLDER):
-    fpath = os.path.join(IMAGE_FOLDER, fname)
-    tpath = os.path.join(IMAGE_FOLDER, "thumb", fname)
-    if os.path.exists(tpath):
-        print(fname, "exists")
-        continue
-    try:
-        img_obj = Image.open(fpath)
-    except IOError:
-        print(fname, "is not a valid image")
-        continue
-    imgtype = img_obj.format
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create the thumbnails and other renditions of the images."
+    )
+    parser.add_argument("--folder", help="The image folder; defaults to the server's folder")
+    parser.add_argument(
+        "--rendition",
+        action="append",
+        choices=list(thumbnails.RENDITIONS),
+        help="Only build this rendition; may be given more than once",
+    )
+    parser.add_argument("--workers", type=int, help="Number of processes; defaults to the CPUs")
+    parser.add_argument("--force", action="store_true", help="Rebuild all the renditions")
+    args = parser.parse_args()
+    thumbnails.build_renditions(
+        args.folder, args.rendition, workers=args.workers, force=args.force
+    )
 
-    # Make a thumbnail
-    thumb_size = (120, 120)
-    img_obj.thumbnail(thumb_size)
-    img_obj.save(tpath, format=imgtype)
-    print("Thumbnail for %s was created" % fname)
+
+if __name__ == "__main__":
+    main()
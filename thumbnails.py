@@ -0,0 +1,368 @@
+"""Builds the thumbnails and the other reduced-size renditions of the images.
+
+Each rendition is kept in its own folder under the image folder, with the same name as
+the original, and is scaled to fit within the size given for it in RENDITIONS. A
+rendition that is older than its original is rebuilt; one that is newer is left alone,
+so an interrupted build can be run again and will pick up where it stopped.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+import images
+
+THUMB_SIZE = (120, 120)
+# The name of each rendition, which is also its folder, and the size that it must fit
+# within. Besides the thumbnails used in the listings and a preview for the grid views,
+# there is one for each frame resolution, in both orientations.
+RENDITIONS = {
+    "thumbs": THUMB_SIZE,
+    "preview": (480, 480),
+    "1280x800": (1280, 800),
+    "800x1280": (800, 1280),
+    "1920x1080": (1920, 1080),
+    "1080x1920": (1080, 1920),
+}
+JPEG_QUALITY = 85
+# How images can be resized on demand: 'contain' fits the image within the requested
+# size, and 'cover' fills it, cropping whatever doesn't fit.
+FIT_MODES = ("contain", "cover")
+MAX_RESIZE_DIMENSION = 4096
+# The resized images are kept in the 'cache' folder, up to this many bytes in total.
+RESIZE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# The cache is checked for size after this many images are added to it by a worker
+RESIZE_CACHE_TRIM_EVERY = 50
+# The number of lock files used to keep workers from making the same image at once
+RESIZE_CACHE_LOCKS = 64
+# Seconds before a temporary file in the cache is taken to be left over from a stopped
+# build, rather than one that is still being written
+RESIZE_CACHE_TMP_GRACE = 600
+# The number of threads in each worker that make the renditions for new uploads
+RENDITION_THREADS = 2
+# How often to report progress, in number of images
+REPORT_EVERY = 500
+
+LOG = logging.getLogger("photo")
+_cache_writes = 0
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def rendition_folder(rendition, img_dir=None):
+    return os.path.join(img_dir or images.IMAGE_FOLDER, rendition)
+
+
+def thumb_folder(img_dir=None):
+    return rendition_folder("thumbs", img_dir)
+
+
+def rendition_paths(fname, img_dir=None, renditions=None):
+    """Returns a dict of the path to each rendition of the image."""
+    renditions = renditions or RENDITIONS
+    return {
+        rendition: os.path.join(rendition_folder(rendition, img_dir), fname)
+        for rendition in renditions
+    }
+
+
+def needs_thumbnail(fpath, tpath):
+    """Returns True if the thumbnail or rendition is missing, or older than the original."""
+    try:
+        return os.stat(tpath).st_mtime < os.stat(fpath).st_mtime
+    except FileNotFoundError:
+        return True
+
+
+def _scale(width, height, box):
+    """Returns the factor that an image is scaled by to fit within the box, without
+    being enlarged.
+    """
+    return min(box[0] / width, box[1] / height, 1)
+
+
+def pick_rendition(width, height, req_width, req_height, fit="contain"):
+    """Returns the name of the smallest rendition of a `width` x `height` image that is
+    at least as large as the image would be when scaled to fit within `req_width` x
+    `req_height`, or to cover it if `fit` is 'cover'. Returns None if only the original
+    will do.
+    """
+    if fit == "cover":
+        needed = min(max(req_width / width, req_height / height), 1)
+    else:
+        needed = _scale(width, height, (req_width, req_height))
+    best = None
+    for rendition, box in RENDITIONS.items():
+        scale = _scale(width, height, box)
+        if scale >= needed and (best is None or scale < best[1]):
+            best = (rendition, scale)
+    if best is None or best[1] >= 1:
+        # It would be as large as the original
+        return None
+    return best[0]
+
+
+def _save(img_obj, tpath, imgtype, quality=None):
+    """Writes to a temporary file that is then renamed, so a build that is stopped part
+    way never leaves a truncated file that looks up to date.
+    """
+    os.makedirs(os.path.dirname(tpath), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(tpath, os.getpid())
+    kwargs = {"quality": quality or JPEG_QUALITY} if imgtype in ("JPEG", "WEBP") else {}
+    try:
+        img_obj.save(tmp_path, format=imgtype, **kwargs)
+        os.replace(tmp_path, tpath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def make_renditions(fpath, img_dir=None, renditions=None):
+    """Creates the renditions of a single image; by default, all of them.
+
+    The original is decoded only once. For JPEGs, draft() has the decoder scale the
+    image down by up to 8x as it reads it, which is much faster than decoding it at full
+    size. Each rendition is then made from the next larger one, rather than from the
+    original.
+    """
+    renditions = renditions or list(RENDITIONS)
+    fname = os.path.basename(fpath)
+    paths = rendition_paths(fname, img_dir or os.path.dirname(fpath), renditions)
+    with Image.open(fpath) as img_obj:
+        imgtype = img_obj.format
+        width, height = img_obj.size
+        # All the renditions have the same shape as the original, so one that is scaled
+        # down less has all the pixels needed to make one that is scaled down more.
+        ordered = sorted(
+            renditions, key=lambda rendition: _scale(width, height, RENDITIONS[rendition])
+        )
+        ordered.reverse()
+        img_obj.draft(img_obj.mode, RENDITIONS[ordered[0]])
+        source = img_obj
+        for rendition in ordered:
+            rendered = source.copy()
+            rendered.thumbnail(RENDITIONS[rendition])
+            _save(rendered, paths[rendition], imgtype)
+            source = rendered
+
+
+def resize_cache_folder(img_dir=None):
+    return os.path.join(img_dir or images.IMAGE_FOLDER, "cache")
+
+
+def _touch(path):
+    """Marks a cached image as just used, for the eviction order. Returns False if it
+    isn't in the cache.
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def resized_image(fname, width, height, fit="contain", quality=None, source=None, img_dir=None):
+    """Returns the path to a copy of the image resized to `width` x `height`, either of
+    which may be None if `fit` is 'contain'. It is made from `source`, a path to the
+    original or to a rendition that is large enough, which defaults to the original.
+
+    The copy is made once and then kept in the resize cache. A lock file ensures that
+    when several workers ask for the same copy at once, only one of them makes it, and
+    the rest wait for it and then use it.
+    """
+    img_dir = img_dir or images.IMAGE_FOLDER
+    fpath = os.path.join(img_dir, fname)
+    source = source or fpath
+    # Include the original's mtime, so that a changed image isn't served from the cache
+    variant = "{}|{}|{}|{}|{}|{}".format(
+        fname, os.stat(fpath).st_mtime_ns, width, height, fit, quality
+    )
+    key = hashlib.sha1(variant.encode("utf-8")).hexdigest()
+    cache_dir = resize_cache_folder(img_dir)
+    cache_path = os.path.join(cache_dir, key + os.path.splitext(fname)[1])
+    if _touch(cache_path):
+        return cache_path
+    lock_dir = os.path.join(cache_dir, ".locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_path = os.path.join(lock_dir, str(int(key[:8], 16) % RESIZE_CACHE_LOCKS))
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Another worker may have made it while this one was waiting for the lock
+            if not _touch(cache_path):
+                _resize(source, cache_path, width, height, fit, quality)
+                _after_cache_write(img_dir)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return cache_path
+
+
+def _resize(source, cache_path, width, height, fit, quality):
+    with Image.open(source) as img_obj:
+        imgtype = img_obj.format
+        box = (width or MAX_RESIZE_DIMENSION, height or MAX_RESIZE_DIMENSION)
+        img_obj.draft(img_obj.mode, box)
+        if fit == "cover":
+            resized = ImageOps.fit(img_obj, box, method=Image.LANCZOS)
+        else:
+            resized = img_obj.copy()
+            resized.thumbnail(box)
+        _save(resized, cache_path, imgtype, quality)
+
+
+def _after_cache_write(img_dir):
+    global _cache_writes
+    _cache_writes += 1
+    if _cache_writes >= RESIZE_CACHE_TRIM_EVERY:
+        _cache_writes = 0
+        trim_resize_cache(img_dir=img_dir)
+
+
+def trim_resize_cache(max_bytes=None, img_dir=None):
+    """If the cached images take more than `max_bytes`, deletes the ones that were used
+    least recently until they take no more than 90% of it. Returns the number deleted.
+    Temporary files that another worker may still be writing are left alone.
+    """
+    max_bytes = max_bytes or RESIZE_CACHE_MAX_BYTES
+    tmp_cutoff = time.time() - RESIZE_CACHE_TMP_GRACE
+    entries = []
+    with os.scandir(resize_cache_folder(img_dir)) as scan:
+        for entry in scan:
+            if entry.is_file():
+                stat = entry.stat()
+                if entry.name.endswith(".tmp") and stat.st_mtime > tmp_cutoff:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for mtime, size, path in entries)
+    if total <= max_bytes:
+        return 0
+    deleted = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes * 0.9:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+    return deleted
+
+
+def queue_renditions(fpath, img_dir=None):
+    """Makes the renditions of a new image in a background thread, so that the upload
+    doesn't wait for them. Returns the Future. A new pool of threads is started if the
+    process has forked since the last one was.
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=RENDITION_THREADS, thread_name_prefix="renditions"
+            )
+            _executor_pid = os.getpid()
+        future = _executor.submit(make_renditions, fpath, img_dir)
+
+    def log_failure(fut):
+        if fut.exception():
+            LOG.error("Could not create the renditions for %s: %s", fpath, fut.exception())
+
+    future.add_done_callback(log_failure)
+    return future
+
+
+def remove_renditions(fname, img_dir=None):
+    for path in rendition_paths(fname, img_dir).values():
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def rename_renditions(orig_name, new_name, img_dir=None):
+    new_paths = rendition_paths(new_name, img_dir)
+    for rendition, path in rendition_paths(orig_name, img_dir).items():
+        try:
+            os.replace(path, new_paths[rendition])
+        except FileNotFoundError:
+            pass
+
+
+def _build_one(args):
+    """Runs in the worker processes. Returns the file name and an error message, which
+    is None if the renditions were created.
+    """
+    fpath, img_dir, renditions = args
+    try:
+        make_renditions(fpath, img_dir, renditions)
+    except Exception as e:
+        return os.path.basename(fpath), str(e)
+    return os.path.basename(fpath), None
+
+
+def build_renditions(img_dir=None, renditions=None, workers=None, force=False, report=print):
+    """Creates the missing and out-of-date renditions for all the images in `img_dir`,
+    using a pool of `workers` processes (by default, one per CPU). `renditions` limits
+    the build to the named renditions. If `force` is True, they are all rebuilt.
+    Progress is passed to `report` as a string.
+
+    Returns a dict with the number of images that were 'built', 'skipped' and 'failed',
+    and the 'elapsed' seconds.
+    """
+    img_dir = img_dir or images.IMAGE_FOLDER
+    renditions = list(renditions or RENDITIONS)
+    todo = []
+    skipped = 0
+    with os.scandir(img_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            paths = rendition_paths(entry.name, img_dir, renditions)
+            stale = [
+                rendition
+                for rendition, path in paths.items()
+                if force or needs_thumbnail(entry.path, path)
+            ]
+            if stale:
+                todo.append((entry.path, img_dir, stale))
+            else:
+                skipped += 1
+    report("{} images to process; {} are up to date".format(len(todo), skipped))
+    stats = {"built": 0, "skipped": skipped, "failed": 0}
+    start = time.time()
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Send the work in chunks, so the cost of each round trip to a worker is
+            # spread across many images.
+            chunksize = max(1, min(64, len(todo) // ((workers or os.cpu_count() or 1) * 4)))
+            for num, (fname, error) in enumerate(
+                executor.map(_build_one, todo, chunksize=chunksize), 1
+            ):
+                if error:
+                    stats["failed"] += 1
+                    report("Could not create the renditions for {}: {}".format(fname, error))
+                else:
+                    stats["built"] += 1
+                if num % REPORT_EVERY == 0:
+                    elapsed = time.time() - start
+                    report(
+                        "{} of {} done; {:.1f} images/sec".format(num, len(todo), num / elapsed)
+                    )
+    stats["elapsed"] = time.time() - start
+    rate = len(todo) / stats["elapsed"] if stats["elapsed"] else 0
+    report(
+        "Built {built}, failed {failed}, skipped {skipped}".format(**stats)
+        + " in {:.1f} seconds ({:.1f} images/sec)".format(stats["elapsed"], rate)
+    )
+    return stats
+
+
+def build_thumbnails(img_dir=None, workers=None, force=False, report=print):
+    """Creates the missing and out-of-date thumbnails. See build_renditions()."""
+    return build_renditions(img_dir, ["thumbs"], workers=workers, force=force, report=report)
@@ -1,4 +1,5 @@
 import builtins
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps, update_wrapper
 import json
@@ -6,23 +7,32 @@ import logging
 from math import log
 import os
 from subprocess import Popen, PIPE
+import threading
 import time
 import uuid
 
 import etcd3
-from flask import make_response
+from flask import g, has_request_context, make_response
 from PIL import Image
 import pymysql
 
 import entities
 import images
+import thumbnails
 
 
 main_cursor = None
 HOST = "dodata"
 conn = None
+db_creds = None
 etcd_client = None
 BASE_KEY = "/{uuid}:{topic}"
+# Limits for a single etcd transaction; the server defaults are 128 operations and 1.5MB
+ETCD_MAX_TXN_OPS = 128
+ETCD_MAX_TXN_BYTES = 1024 * 1024
+ETCD_MAX_PARALLEL = 4
+# Seconds that the record of a broadcast command, and its acknowledgements, are kept
+COMMAND_TTL = 24 * 60 * 60
 DEFAULT_PAGE_SIZE = 50
 
 LOG = logging.getLogger("photo")
@@ -33,6 +43,7 @@ LOG.addHandler(hnd)
 LOG.setLevel(logging.DEBUG)
 
 IntegrityError = pymysql.err.IntegrityError
+DB_POOL_SIZE = 10
 
 
 def logit(*msgs):
@@ -84,10 +95,18 @@ def parse_creds():
     return DotDict(ret)
 
 
+def get_creds():
+    """Returns the credentials in .dbcreds, which are only read the first time."""
+    global db_creds
+    if db_creds is None:
+        db_creds = parse_creds()
+    return db_creds
+
+
 def connect(creds=None):
     cls = pymysql.cursors.DictCursor
     # If credentials aren't supplied, use the ones in .dbcreds
-    creds = creds or parse_creds()
+    creds = creds or get_creds()
     ret = pymysql.connect(
         host=creds.get("host") or HOST,
         user=creds["username"],
@@ -99,6 +118,120 @@ def connect(creds=None):
     return ret
 
 
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """A bounded pool of DB connections, used by DbCursor.
+
+    At most `max_size` connections are open at once; when they are all in use,
+    `get()` waits up to `timeout` seconds for one to be returned. Connections
+    that have sat idle longer than `max_idle` seconds are closed rather than
+    reused, and those idle longer than `check_after` seconds are pinged before
+    being handed out. If the process has forked since the pool was last used,
+    the parent's connections are abandoned and the pool starts over.
+    """
+
+    def __init__(self, max_size=10, max_idle=300, check_after=30, timeout=10):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        # Tuples of (connection, time it was returned to the pool)
+        self._idle = []
+        self._in_use = 0
+        self.metrics = dict.fromkeys(
+            ("created", "reused", "discarded", "waits", "timeouts", "health_checks"), 0
+        )
+
+    def _check_pid(self):
+        if os.getpid() != self.pid:
+            # We are in a forked child, and the connections belong to the parent.
+            # Don't close them, as that would close the parent's connections too.
+            self._reset()
+
+    def get(self):
+        """Returns an open connection, reusing an idle one if possible."""
+        self._check_pid()
+        deadline = time.time() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._in_use >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.metrics["timeouts"] += 1
+                        msg = "No DB connection available after %s seconds" % self.timeout
+                        raise PoolTimeout(msg)
+                    self.metrics["waits"] += 1
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                self._in_use += 1
+            if conn is None:
+                try:
+                    conn = connect()
+                except Exception:
+                    self._release()
+                    raise
+                self.metrics["created"] += 1
+                return conn
+            if self._is_healthy(conn, last_used):
+                self.metrics["reused"] += 1
+                return conn
+            self.discard(conn)
+
+    def _is_healthy(self, conn, last_used):
+        idle_time = time.time() - last_used
+        if not conn.open or idle_time > self.max_idle:
+            return False
+        if idle_time > self.check_after:
+            self.metrics["health_checks"] += 1
+            try:
+                conn.ping(reconnect=False)
+            except pymysql.err.Error:
+                return False
+        return True
+
+    def put(self, conn):
+        """Returns a connection to the pool."""
+        if os.getpid() != self.pid:
+            return
+        if not conn.open:
+            self.discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._in_use -= 1
+            self._cond.notify()
+
+    def discard(self, conn):
+        """Closes a checked-out connection instead of returning it to the pool."""
+        self.metrics["discarded"] += 1
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+        self._release()
+
+    def _release(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                self.metrics, in_use=self._in_use, idle=len(self._idle), max_size=self.max_size
+            )
+
+
 def gen_uuid():
     return str(uuid.uuid4())
 
@@ -107,6 +240,8 @@ def get_cursor():
     try:
         return builtins.TEST_CURSOR
     except AttributeError:
+        if has_request_context():
+            return request_connection().cursor(pymysql.cursors.DictCursor)
         global conn, main_cursor
         if not (conn and conn.open):
             LOG.debug("No DB connection")
@@ -119,30 +254,115 @@ def get_cursor():
         return main_cursor
 
 
+# While handling a web request, all DB access shares a single connection from the pool,
+# checked out the first time it's needed. Everything done in the request is a single
+# transaction that is committed if the request succeeds, and rolled back if it fails.
+# Changes are pushed to the frames with after_commit(), so that they are only sent once
+# the request's transaction has been committed.
+
+
+def request_connection():
+    """Returns the connection for the current request."""
+    if "db_conn" not in g:
+        g.db_conn = pool.get()
+    return g.db_conn
+
+
+def after_commit(fnc, *args, **kwargs):
+    """Calls the function once the current request's transaction has been committed, or
+    right away outside of a request. The calls are dropped if the request fails.
+    """
+    if not has_request_context():
+        return fnc(*args, **kwargs)
+    g.setdefault("after_commit", []).append((fnc, args, kwargs))
+
+
+def commit_request(response):
+    """Flask after_request handler that commits the request's transaction, unless the
+    response is an error, and then makes the calls queued by after_commit().
+    """
+    if response.status_code >= 400:
+        return response
+    db_conn = g.get("db_conn")
+    if db_conn is not None:
+        db_conn.commit()
+        pool.put(g.pop("db_conn"))
+    for fnc, args, kwargs in g.pop("after_commit", []):
+        try:
+            fnc(*args, **kwargs)
+        except Exception:
+            LOG.exception("Failed to call %s after the commit", fnc.__name__)
+    return response
+
+
+def release_request(exc=None):
+    """Flask teardown_request handler that rolls back anything that wasn't committed,
+    and returns the connection to the pool.
+    """
+    # Nothing was committed, so the frames mustn't be told about any of it
+    g.pop("after_commit", None)
+    db_conn = g.pop("db_conn", None)
+    if db_conn is None:
+        return
+    try:
+        db_conn.rollback()
+    except pymysql.err.Error:
+        pool.discard(db_conn)
+        return
+    pool.put(db_conn)
+
+
 class DbCursor:
     def __init__(self, commit=True):
         self.commit = commit
+        self.pooled = False
         try:
             # See if we're running in test mode
             self.cursor = builtins.TEST_CURSOR
             self.conn = self.cursor.connection
-            self.close_conn = False
+            self.in_request = False
         except AttributeError:
-            self.conn = connect()
+            self.in_request = has_request_context()
+            if self.in_request:
+                # Part of the request's transaction
+                self.conn = request_connection()
+            else:
+                self.conn = pool.get()
+                self.pooled = True
             self.cursor = self.conn.cursor(pymysql.cursors.DictCursor)
-            self.close_conn = True
 
     def __enter__(self):
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        if self.commit:
-            self.conn.commit()
-        if self.close_conn:
-            self.conn.close()
+        if self.in_request:
+            # The request handlers take care of committing
+            return
+        if not self.pooled:
+            if self.commit:
+                self.conn.commit()
+            return
+        try:
+            if self.commit and exc_type is None:
+                self.conn.commit()
+            else:
+                # Don't return a connection with an open transaction to the pool
+                self.conn.rollback()
+        except pymysql.err.Error:
+            pool.discard(self.conn)
+            if exc_type is None:
+                raise
+            return
+        pool.put(self.conn)
+
+
+pool = ConnectionPool(max_size=DB_POOL_SIZE)
 
 
 def commit():
+    if has_request_context():
+        # Committed when the request finishes
+        return
     conn.commit()
 
 
@@ -153,20 +373,40 @@ def _get_etcd_client():
     return etcd_client
 
 
-def read_key(uuid, topic=None):
+def read_key(uuid, topic=None, timeout=10):
+    """Waits up to `timeout` seconds for the key to be written, and returns its value. A
+    watch is used, so this returns as soon as the key is written. If it isn't written
+    in time, returns "TIMEOUT".
+    """
     full_key = BASE_KEY.format(uuid=uuid, topic=topic or "")
-    print("FULL KEY", full_key)
     clt = _get_etcd_client()
-    start = time.time()
-    timeout = start + 10
-    key, meta = clt.get(full_key)
-    while not key and time.time() < timeout:
-        time.sleep(0.5)
-        key, meta = clt.get(full_key)
-        print(timeout - time.time())
-    if key:
-        return json.loads(key)
-    return "TIMEOUT"
+    events_iterator, cancel = clt.watch(full_key)
+    # Cancelling the watch ends the events iterator
+    timer = threading.Timer(timeout, cancel)
+    timer.start()
+    try:
+        # The key may have been written before the watch started
+        value, meta = clt.get(full_key)
+        if value is None:
+            for event in events_iterator:
+                if isinstance(event, etcd3.events.PutEvent):
+                    value = event.value
+                    break
+    finally:
+        timer.cancel()
+        cancel()
+    if value is None:
+        return "TIMEOUT"
+    return json.loads(value)
+
+
+def peek_key(uuid, topic=None):
+    """Returns the value of the key if it has been written, or None, without waiting."""
+    full_key = BASE_KEY.format(uuid=uuid, topic=topic or "")
+    value, meta = _get_etcd_client().get(full_key)
+    if value is None:
+        return None
+    return json.loads(value)
 
 
 def watch(prefix, callback):
@@ -193,9 +433,102 @@ def write_key(uuid, topic, val):
     debugout("Wrote key: '%s', with value '%s'" % (full_key, payload))
 
 
+def write_keys(uuids, topic, val):
+    """Writes the same value to the topic key of each of the uuids, such as an album's
+    image list to all the frames that display it. See write_topics().
+    """
+    return write_topics(uuids, {topic: val})
+
+
+def write_topics(uuids, values):
+    """Writes the same values to the keys of each of the uuids. `values` is a dict of
+    topics and their values. Each value is serialized once, and the keys are written in
+    a single etcd transaction. If there are too many keys, or too much data, for one
+    transaction, they are split into chunks that are written in parallel; all of a
+    uuid's topics are always in the same chunk, so a frame never sees some of them
+    updated without the others.
+
+    Returns a dict with True or False for each full key, showing if it was written.
+    """
+    uuids = list(uuids)
+    if not uuids or not values:
+        return {}
+    clt = _get_etcd_client()
+    payloads = {topic: json.dumps(val) for topic, val in values.items()}
+    uuid_bytes = sum(len(payload) for payload in payloads.values())
+    per_txn = max(1, min(ETCD_MAX_TXN_OPS // len(payloads), ETCD_MAX_TXN_BYTES // uuid_bytes))
+    chunks = [uuids[pos : pos + per_txn] for pos in range(0, len(uuids), per_txn)]
+
+    def put_chunk(chunk):
+        keys = [
+            (BASE_KEY.format(uuid=uuid, topic=topic), payload)
+            for uuid in chunk
+            for topic, payload in payloads.items()
+        ]
+        ops = [clt.transactions.put(key, payload) for key, payload in keys]
+        try:
+            succeeded = clt.transaction(compare=[], success=ops, failure=[])[0]
+        except etcd3.exceptions.Etcd3Exception as e:
+            LOG.error(f"Failed to write keys: {[key for key, payload in keys]}: {e}")
+            succeeded = False
+        return {key: bool(succeeded) for key, payload in keys}
+
+    results = {}
+    if len(chunks) == 1:
+        results.update(put_chunk(chunks[0]))
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(chunks), ETCD_MAX_PARALLEL)) as executor:
+            for chunk_results in executor.map(put_chunk, chunks):
+                results.update(chunk_results)
+    num_ok = sum(results.values())
+    topics = ", ".join(f"'{topic}'" for topic in payloads)
+    LOG.debug(f"Wrote {num_ok} of {len(results)} {topics} keys, with values {payloads}.")
+    debugout(f"Wrote {num_ok} of {len(results)} {topics} keys in {len(chunks)} transactions")
+    return results
+
+
+def broadcast_command(uuids, topic, val):
+    """Sends a command to several frames at once. Each frame's topic key is written with
+    {"command_id": ..., "value": val, "lease": ...}, using write_keys(), and the frames
+    acknowledge it by writing their answer to the '/<command_id>:ack/<uuid>' key. A
+    record of the command and the frames it was sent to is kept under
+    '/<command_id>:command'.
+
+    The record is attached to an etcd lease that expires after COMMAND_TTL seconds. The
+    frames should attach their acknowledgements to the same lease, whose ID is sent with
+    the command; the frame state cache attaches any that they don't.
+
+    Returns the command_id and the results from write_keys().
+    """
+    command_id = gen_uuid()
+    clt = _get_etcd_client()
+    lease = clt.lease(COMMAND_TTL)
+    record = {"topic": topic, "value": val, "frames": list(uuids), "lease": lease.id}
+    clt.put(BASE_KEY.format(uuid=command_id, topic="command"), json.dumps(record), lease=lease)
+    results = write_keys(uuids, topic, {"command_id": command_id, "value": val, "lease": lease.id})
+    return command_id, results
+
+
+def command_acks(command_id):
+    """Returns a dict of the acknowledgements that have been written for a command sent by
+    broadcast_command(), keyed by the uuid of the frame. They are all read in a single
+    range request.
+    """
+    prefix = BASE_KEY.format(uuid=command_id, topic="ack/")
+    clt = _get_etcd_client()
+    acks = {}
+    for value, meta in clt.get_prefix(prefix):
+        uuid = str(meta.key, "UTF-8")[len(prefix) :]
+        acks[uuid] = json.loads(value)
+    return acks
+
+
 def get_img_orientation(fpath):
     img = Image.open(fpath)
-    width, height = img.size
+    return orientation_for_size(*img.size)
+
+
+def orientation_for_size(width, height):
     if width == height:
         orientation = "S"
     elif width > height:
@@ -207,14 +540,20 @@ def get_img_orientation(fpath):
 
 def update_img_db(img_dir=None, cursor=None):
     """Great for restoring the image information after resetting the DB. It
-    loses any custom keywords that may have been set, though.
+    loses any custom keywords that may have been set, though. Files with the same
+    contents as an image that is already in the database are skipped.
     """
     img_dir = img_dir or images.IMAGE_FOLDER
     disk_images = os.listdir(img_dir)
-    db_images = images.list_db_images()
-    db_names = [db_img["name"] for db_img in db_images]
+    crs = cursor or get_cursor()
+    crs.execute("select name, content_hash from image;")
+    db_images = crs.fetchall()
+    db_names = {db_img["name"] for db_img in db_images}
+    db_hashes = {db_img["content_hash"] for db_img in db_images if db_img["content_hash"]}
+    added = False
     for disk_img in disk_images:
-        if disk_img in db_names:
+        # Hidden files include the uploads that are still being written
+        if disk_img in db_names or disk_img.startswith("."):
             continue
         fpath = os.path.join(img_dir, disk_img)
         try:
@@ -222,6 +561,11 @@ def update_img_db(img_dir=None, cursor=None):
         except IOError:
             # Not a valid image file; delete maybe?
             continue
+        content_hash = images.file_hash(fpath)
+        if content_hash in db_hashes:
+            # The same image is already stored under another name
+            continue
+        db_hashes.add(content_hash)
         # Add back to the database
         pkid = gen_uuid()
         name = disk_img
@@ -234,34 +578,68 @@ def update_img_db(img_dir=None, cursor=None):
         updated = datetime.fromtimestamp(osstat.st_ctime)
         sql = """
                 insert into image (pkid, keywords, name, orientation, width,
-                    height, imgtype, size, updated)
-                values (%s, %s, %s, %s, %s, %s, %s, %s, %s); """
-        vals = (pkid, keywords, name, orientation, width, height, imgtype, size, updated)
-        crs = cursor or get_cursor()
+                    height, imgtype, size, content_hash, updated)
+                values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s); """
+        vals = (
+            pkid,
+            keywords,
+            name,
+            orientation,
+            width,
+            height,
+            imgtype,
+            size,
+            content_hash,
+            updated,
+        )
         crs.execute(sql, vals)
+        entities.Image.index_keywords(crs, pkid, keywords)
+        added = True
     # Save the db changes
     try:
         commit()
     except AttributeError:
         # No global connection; running as a test fixture
         pass
+    if added:
+        entities.Album.refresh_all_smart_albums()
+
+
+def rebuild_keyword_index(cursor=None):
+    """Rebuilds the image_keyword table from the keywords stored in the image
+    table. Used to populate it the first time, or if it gets out of sync.
+    """
+    crs = cursor or get_cursor()
+    crs.execute("select pkid, keywords from image;")
+    recs = crs.fetchall()
+    crs.execute("delete from image_keyword;")
+    rows = [(rec["pkid"], word) for rec in recs for word in split_keywords(rec["keywords"])]
+    if rows:
+        sql = "insert into image_keyword (image_id, keyword) values (%s, %s)"
+        crs.executemany(sql, rows)
+    rebuild_keyword_vocab(cursor=crs)
+
+
+def rebuild_keyword_vocab(cursor=None):
+    """Recalculates the keyword_vocab counts from the image_keyword table.
+    Normally the counts are kept current as image keywords change; this is
+    for recovering if they ever drift.
+    """
+    crs = cursor or get_cursor()
+    crs.execute("delete from keyword_vocab;")
+    sql = """insert into keyword_vocab (keyword, image_count)
+            select keyword, count(*) from image_keyword group by keyword;"""
+    crs.execute(sql)
+    try:
+        commit()
+    except AttributeError:
+        # No global connection; running as a test fixture
+        pass
 
 
 def update_image_thumbnails(img_dir=None):
-    img_dir = img_dir or images.IMAGE_FOLDER
-    thumb_dir = os.path.join(img_dir, "thumb")
-    disk_images = os.listdir(img_dir)
-    thumb_images = os.listdir(thumb_dir)
-    thumb_size = (120, 120)
-    for img in disk_images:
-        img_path = os.path.join(images.IMAGE_FOLDER, img)
-        if img in thumb_images or not os.path.isfile(img_path):
-            continue
-        img_path = os.path.join(img_dir, img)
-        thumb_path = os.path.join(thumb_dir, img)
-        img_obj = Image.open(img_path)
-        img_obj.thumbnail(thumb_size)
-        img_obj.save(thumb_path)
+    """Creates any missing or out-of-date thumbnails. See thumbnails.build_thumbnails()."""
+    return thumbnails.build_thumbnails(img_dir, report=LOG.info)
 
 
 def debugout(*args):
@@ -304,11 +682,21 @@ def human_fmt(num):
         return "1 byte"
 
 
+def split_keywords(keywords):
+    """Returns the distinct words in a keywords string, lower-cased, which is
+    how they are stored in the image_keyword table.
+    """
+    return sorted(set((keywords or "").lower().split()))
+
+
+def keyword_counts():
+    """Returns a dict of every keyword in use, with the number of images that
+    have that keyword.
+    """
+    with DbCursor() as crs:
+        crs.execute("select keyword, image_count from keyword_vocab order by keyword;")
+    return {rec["keyword"]: rec["image_count"] for rec in crs.fetchall()}
+
+
 def all_keywords():
-    imgs = entities.Image.list()
-    kws = [img.keywords for img in imgs]
-    all_kws = set()
-    for kw_list in kws:
-        wds = set(kw_list.split())
-        all_kws.update(wds)
-    return sorted(list(all_kws))
+    return list(keyword_counts())